@@ -0,0 +1,380 @@
+#!/usr/bin/env python2
+# vim: sw=4 ts=8 softtabstop=4 tw=79 expandtab
+
+"""
+A python program that benchmarks the stages of recent_additions_updator on a
+synthetic corpus, so changes to the updator can be measured without running
+it on the real shares.
+
+The corpus is built in a work directory (preferably on a tmpfs or a loop
+device, so the results do not depend on the disk the program is run from).
+It holds;
+
+ * scan    - a tree of files with sizes spread evenly on a log scale between
+                --min-size and --max-size, --depth directories deep with
+                --fanout subdirectories per directory. Only the first
+                --head bytes of each file are random, the rest is sparse.
+ * target  - the recent additions directory of the scan tree.
+ * datafile - the datafile of the scan tree.
+ * synthetic.datafile - a datafile of --records made up files (with their
+                STAT and LINK records), used to time loading.
+
+The stages timed are;
+
+ * migrate     - with --storage sqlite, the first Datafile.Load of the
+                synthetic datafile, which moves its records into the
+                database.
+ * load        - Datafile.Load of the synthetic datafile (of its database
+                with --storage sqlite).
+ * locate      - listing the scan tree with locate (os.walk).
+ * walk        - listing and stating the scan tree with walk (scandir).
+ * partial_shasum - hashing every file of the scan tree.
+ * check_file  - checking every file of the scan tree into an empty
+                datafile, creating the links.
+ * churn       - checking the scan tree again after --churn of the files
+                have been renamed or moved.
+ * rescan      - checking the unchanged scan tree again.
+ * create_link - creating the links of every file of the scan tree in an
+                empty target directory.
+
+The files are read from the page cache, unless the caches are dropped
+between the stages (which needs root, see --drop-caches).
+
+The results are written as JSON, so the results of different versions of the
+updator can be compared.
+"""
+# ::AUTOFILL name::
+# ::AUTOFILL copyleft::
+# ::AUTOFILL license BSD::
+
+import argparse
+import platform
+import random
+import shutil
+import json
+import math
+import time
+import sys
+import os
+
+import recent_additions_updator as rau
+
+
+def log_sizes(rand, count, min_size, max_size):
+    """ Returns count file sizes spread evenly on a log scale between
+        min_size and max_size.
+    """
+    low = math.log(max(min_size, 1))
+    high = math.log(max(max_size, min_size, 1))
+    return [int(math.exp(rand.uniform(low, high))) for i in xrange(count)]
+
+
+def tree_directories(root, depth, fanout):
+    """ Returns the leaf directories of a tree depth directories deep, with
+        fanout subdirectories per directory.
+
+        Every directory has a different name, so the links of same named
+        files are told apart by the name of their directory.
+    """
+    dirs = [root]
+    n = 0
+    for level in xrange(depth):
+        subdirs = list()
+        for d in dirs:
+            for i in xrange(fanout):
+                subdirs.append(os.path.join(d, "dir%d" % n))
+                n += 1
+        dirs = subdirs
+    return dirs
+
+
+def build_tree(root, rand, options):
+    """ Creates the synthetic scan tree in root.
+
+        Returns the list of the filenames created.
+    """
+    dirs = tree_directories(root, options.depth, options.fanout)
+    for d in dirs:
+        os.makedirs(d)
+    filenames = list()
+    sizes = log_sizes(rand, options.files, options.min_size, options.max_size)
+    for i, size in enumerate(sizes):
+        # Same named files in different directories, like series episodes.
+        filename = os.path.join(dirs[i % len(dirs)], "Episode %02d.avi" % (i // len(dirs)))
+        fp = open(filename, 'wb')
+        fp.write(os.urandom(min(size, options.head)))
+        fp.truncate(size)
+        fp.close()
+        filenames.append(filename)
+    return filenames
+
+
+def churn_tree(root, rand, filenames, fraction):
+    """ Renames or moves fraction of the files in the scan tree to a new name.
+
+        Returns the number of files changed.
+    """
+    count = int(len(filenames) * fraction)
+    moved = os.path.join(root, "moved")
+    if not os.path.isdir(moved):
+        os.mkdir(moved)
+    for i, filename in enumerate(rand.sample(filenames, count)):
+        if i % 2:
+            # renamed within its directory
+            newname = os.path.join(os.path.dirname(filename), "renamed %d.avi" % i)
+        else:
+            newname = os.path.join(moved, "moved %d.avi" % i)
+        os.rename(filename, newname)
+    return count
+
+
+def write_datafile(datafilename, root, target, options, records=0, rand=None):
+    """ Writes a datafile for the scan tree root and the recent additions
+        directory target.
+
+        If records is given, that many made up file records (with STAT and
+        LINK records) are appended. Returns the number of records written.
+    """
+    fp = open(datafilename, 'w')
+    fp.write("target = %s\n" % target)
+    fp.write("shaclip = %d\n" % options.shaclip)
+    fp.write("minsize = %d\n" % options.minsize)
+    fp.write("scan = %s\n" % root)
+    if options.storage != 'text':
+        fp.write("storage = %s\n" % options.storage)
+    t = int(time.time())
+    for i in xrange(records):
+        h = "%040x %d" % (rand.getrandbits(160), rand.randint(options.minsize, 1 << 32))
+        filename = "%s/dir%04d/file %d.avi" % (root, i // 1000, i)
+        fp.write("%s %d %s\n" % (h, t, filename))
+        fp.write("STAT %s %d %d %d\n" % (h, 2049, i + 1000, t))
+        for format in rau.BUCKETS:
+            fp.write("LINK %s %s\n" % (h, os.path.join(target, os.path.dirname(format), "file %d.avi" % i)))
+    fp.close()
+    return records * (2 + len(rau.BUCKETS))
+
+
+def make_target(target):
+    """ Creates an empty recent additions directory."""
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    for format in rau.BUCKETS:
+        os.makedirs(os.path.join(target, os.path.dirname(format)))
+
+
+def remove_datafile(datafilename):
+    """ Removes a datafile and the files kept beside it."""
+    for suffix in ['', '.lock', '.sqlite', '.sqlite-wal', '.sqlite-shm', '.text']:
+        if os.path.exists(datafilename + suffix):
+            os.remove(datafilename + suffix)
+
+
+def drop_caches():
+    """ Drops the page cache, so the files are read from the disk."""
+    os.system("sync")
+    fp = open("/proc/sys/vm/drop_caches", 'w')
+    fp.write("3\n")
+    fp.close()
+
+
+def timed(function, *args):
+    """ Calls function with args, returning the (result, seconds) it took."""
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def result(seconds, count, nbytes=None):
+    """ Returns the result dict of a stage that handled count items (and
+        nbytes bytes) in seconds.
+    """
+    r = dict(seconds=seconds, count=count,
+             per_second=count / max(seconds, 0.000001))
+    if nbytes is not None:
+        r['mb_per_second'] = nbytes / (1024.0 * 1024.0) / max(seconds, 0.000001)
+    return r
+
+
+def load_datafile(datafilename):
+    """ Loads the datafile as the datafile of the updator."""
+    rau.datafile = rau.Datafile.Load(datafilename)
+    if hasattr(rau, 'link_names'):
+        # forget the links of the previous stage
+        rau.link_names.clear()
+    return rau.datafile
+
+
+def check_tree():
+    """ Checks the files of the scan tree of the loaded datafile, like a run
+        of the updator. Returns the number of files listed.
+    """
+    counts = dict()
+    rau.check_files(rau.scan_files(False, counts), rau.datafile.config.get('workers', 1))
+    rau.datafile.flush()
+    return counts.get('files', 0)
+
+
+def benchmark(options):
+    """ Builds the corpus in the work directory and times the stages.
+
+        Returns the dict of the results.
+    """
+    rand = random.Random(options.seed)
+    work = os.path.abspath(options.work)
+    root = os.path.join(work, "scan")
+    target = os.path.join(work, "target")
+    datafilename = os.path.join(work, "datafile")
+    synthetic = os.path.join(work, "synthetic.datafile")
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    remove_datafile(datafilename)
+    remove_datafile(synthetic)
+
+    results = dict()
+    filenames, seconds = timed(build_tree, root, rand, options)
+    results['build'] = result(seconds, len(filenames))
+    written = write_datafile(synthetic, root, target, options, options.records, rand)
+
+    def stage(name, function, *args):
+        if options.drop_caches:
+            drop_caches()
+        value, seconds = timed(function, *args)
+        sys.stderr.write("%s: %.3f seconds\n" % (name, seconds))
+        return value, seconds
+
+    rau.Hash.set_shaclip(options.shaclip)
+    rau.Hash.set_engine(options.hash, options.hashbuf, options.mmap)
+
+    if options.storage == 'sqlite':
+        # the records are moved into the database by the first load only
+        d, seconds = stage('migrate', rau.Datafile.Load, synthetic)
+        results['migrate'] = result(seconds, d.record_count)
+        d.close()
+    d, seconds = stage('load', rau.Datafile.Load, synthetic)
+    results['load'] = result(seconds, written)
+    results['load']['index'] = dict(d.index_sizes())
+    d.close()
+
+    count, seconds = stage('locate', lambda: sum(1 for f in rau.locate(root)))
+    results['locate'] = result(seconds, count)
+
+    count, seconds = stage('walk', lambda: sum(1 for f in rau.walk(root)))
+    results['walk'] = result(seconds, count)
+
+    def hash_files():
+        nbytes = 0
+        for filename in filenames:
+            rau.partial_shasum(filename, options.shaclip, options.hash,
+                               options.hashbuf, options.mmap)
+            size = os.path.getsize(filename)
+            nbytes += size if options.shaclip <= 4096 else min(size, options.shaclip)
+        return nbytes
+    nbytes, seconds = stage('partial_shasum', hash_files)
+    results['partial_shasum'] = result(seconds, len(filenames), nbytes)
+
+    make_target(target)
+    write_datafile(datafilename, root, target, options)
+    load_datafile(datafilename)
+    count, seconds = stage('check_file', check_tree)
+    results['check_file'] = result(seconds, count)
+    rau.datafile.close()
+
+    churned = churn_tree(root, rand, filenames, options.churn)
+    load_datafile(datafilename)
+    count, seconds = stage('churn', check_tree)
+    results['churn'] = result(seconds, count)
+    results['churn']['changed'] = churned
+    rau.datafile.close()
+
+    load_datafile(datafilename)
+    count, seconds = stage('rescan', check_tree)
+    results['rescan'] = result(seconds, count)
+    rau.datafile.close()
+
+    # only the links, into an empty target
+    make_target(target)
+    remove_datafile(datafilename)
+    write_datafile(datafilename, root, target, options)
+    load_datafile(datafilename)
+    files = sorted(f for f, st in rau.walk(root))
+    t = time.localtime()
+    def create_links():
+        for filename in files:
+            for format in rau.BUCKETS:
+                rau.create_link(filename, format, t)
+        return len(files) * len(rau.BUCKETS)
+    count, seconds = stage('create_link', create_links)
+    results['create_link'] = result(seconds, count)
+    rau.datafile.close()
+
+    if not options.keep:
+        shutil.rmtree(root)
+        shutil.rmtree(target)
+        remove_datafile(datafilename)
+        remove_datafile(synthetic)
+    return results
+
+
+def main():
+    """ Main function call for the program."""
+    parser = argparse.ArgumentParser(description='Recent Additions Directory updator benchmark.')
+    parser.add_argument('work', nargs='?', default='/tmp/recent_additions_benchmark',
+            help='The directory the corpus is built in (default %(default)s).')
+    parser.add_argument('-o', '--output', dest='output', default=None,
+            help='The file the JSON results are written to (default stdout).')
+    parser.add_argument('--files', dest='files', type=int, default=5000,
+            help='The number of files in the scan tree (default %(default)s).')
+    parser.add_argument('--depth', dest='depth', type=int, default=3,
+            help='The number of directories deep the files are (default %(default)s).')
+    parser.add_argument('--fanout', dest='fanout', type=int, default=8,
+            help='The number of subdirectories per directory (default %(default)s).')
+    parser.add_argument('--min-size', dest='min_size', type=int, default=1024,
+            help='The size of the smallest files in bytes (default %(default)s).')
+    parser.add_argument('--max-size', dest='max_size', type=int, default=4 << 30,
+            help='The size of the largest files in bytes (default %(default)s).')
+    parser.add_argument('--head', dest='head', type=int, default=1 << 20,
+            help='The number of random bytes at the start of each file, the rest is sparse (default %(default)s).')
+    parser.add_argument('--churn', dest='churn', type=float, default=0.05,
+            help='The fraction of the files renamed or moved before the churn stage (default %(default)s).')
+    parser.add_argument('--records', dest='records', type=int, default=100000,
+            help='The number of files in the synthetic datafile (default %(default)s).')
+    parser.add_argument('--shaclip', dest='shaclip', type=int, default=10485760,
+            help='The shaclip parameter of the datafiles (default %(default)s).')
+    parser.add_argument('--minsize', dest='minsize', type=int, default=153600,
+            help='The minsize parameter of the datafiles (default %(default)s).')
+    parser.add_argument('--storage', dest='storage', default='text', choices=['text', 'sqlite'],
+            help='The storage parameter of the datafiles (default %(default)s).')
+    parser.add_argument('--hash', dest='hash', default='sha1', choices=sorted(rau.HASH_ALGORITHMS),
+            help='The hash algorithm (default %(default)s).')
+    parser.add_argument('--hashbuf', dest='hashbuf', type=int, default=rau.HASHBUF,
+            help='The number of bytes read at a time when hashing (default %(default)s).')
+    parser.add_argument('--mmap', dest='mmap', action='store_true', default=False,
+            help='Hashes the files with mmap.')
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+            help='The seed of the random corpus (default %(default)s).')
+    parser.add_argument('--drop-caches', dest='drop_caches', action='store_true', default=False,
+            help='Drops the page cache before each stage (requires root).')
+    parser.add_argument('--keep', dest='keep', action='store_true', default=False,
+            help='Keeps the corpus in the work directory afterwards.')
+
+    options = parser.parse_args()
+    if not os.path.isdir(options.work):
+        os.makedirs(options.work)
+
+    results = dict(time=int(time.time()),
+                   python=platform.python_version(),
+                   options=vars(options),
+                   results=benchmark(options))
+
+    if options.output is None:
+        fp = sys.stdout
+    else:
+        fp = open(options.output, 'w')
+    json.dump(results, fp, indent=2, sort_keys=True)
+    fp.write("\n")
+    if fp is not sys.stdout:
+        fp.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python2
+# vim: sw=4 ts=8 softtabstop=4 tw=79 expandtab
+
+"""
+A python program that answers queries about the files recorded in a recent
+additions datafile (see recent_additions_updator), so other programs do not
+have to parse the datafile or crawl the recent additions directory.
+
+The datafile is only read, without taking its lock, so it can be queried
+while recent_additions_updator is running. Records that are being written are
+not read.
+
+The queries are;
+
+ * added   - the files added between --since and --until, newest first.
+ * hash    - the file recorded last with a given hash (and with --links, its
+                links).
+ * path    - the record of a file, or of the files in a directory.
+
+The results are streamed, in the format of the file records of the datafile
+(<hash> <time> <file>), or as JSON lines with --json.
+
+With the 'sqlite' storage the queries use the indexes of the database. A text
+datafile is read from its end, so the newest records are found first, and
+only the results are kept in memory. The files added with --file-time may be
+out of order in a text datafile.
+"""
+# ::AUTOFILL name::
+# ::AUTOFILL copyleft::
+# ::AUTOFILL license BSD::
+
+import argparse
+import datetime
+import sqlite3
+import signal
+import json
+import time
+import sys
+import os
+
+import recent_additions_updator as rau
+
+# the number of bytes read at a time when reading a datafile backwards.
+BUFSIZE = 64 * 1024
+
+
+def reverse_lines(fp, size, bufsize=BUFSIZE):
+    """ Generator that yields the lines of the first size bytes of fp, last
+        line first. A last line without a newline is skipped, as it may still
+        be being written.
+    """
+    pos = size
+    rest = ''           # the start of a line, continued in the block after it
+    complete = False    # whether rest is the start of a line with a newline
+    while pos > 0:
+        n = min(bufsize, pos)
+        pos -= n
+        fp.seek(pos)
+        lines = (fp.read(n) + rest).split('\n')
+        rest = lines.pop(0)
+        if not complete and lines:
+            lines.pop()
+            complete = True
+        for line in reversed(lines):
+            yield line + '\n'
+    if complete and rest:
+        yield rest + '\n'
+
+
+def parse_time(value):
+    """ Parses a time given as seconds since the epoch, or as a local
+        YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS date.
+    """
+    if value.isdigit():
+        return int(value)
+    for format in ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return int(time.mktime(time.strptime(value, format)))
+        except ValueError:
+            pass
+    raise ValueError("invalid time: %s" % value)
+
+
+class Query:
+    """ Read only queries over the records of a text datafile.
+
+        The records are read from the end of the datafile, as it was when
+        the query started.
+    """
+
+    @staticmethod
+    def Open(datafilename):
+        """ Opens the datafile for queries, without locking it.
+
+            If the datafile only holds parameters and its storage parameter
+            is 'sqlite' a SqliteQuery is returned instead.
+        """
+        config = dict()
+        records = False
+        fp = open(datafilename, 'r')
+        for line in fp:
+            try:
+                kind, args, line = next(rau.iter_records([line]))
+            except (ValueError, AttributeError):
+                kind = None
+            if kind != 'config':
+                # the records have not been migrated (yet)
+                records = True
+                break
+            key, value = args
+            config[key] = value
+        fp.close()
+        if not records and config.get('storage', 'text') == 'sqlite':
+            return SqliteQuery(datafilename, config.get('database', datafilename + '.sqlite'))
+        return Query(datafilename)
+
+    def __init__(self, datafilename):
+        self.datafilename = datafilename
+
+    def _records(self):
+        # Yields the (kind, args) of the records, last record first.
+        fp = open(self.datafilename, 'r')
+        try:
+            size = os.fstat(fp.fileno()).st_size
+            for kind, args, line in rau.iter_records(reverse_lines(fp, size)):
+                yield kind, args
+        finally:
+            fp.close()
+
+    def added(self, since=None, until=None):
+        """ Generator that yields the (hash, time, filename) of the file
+            recorded last with each hash, for the hashes added at or after
+            since and before until (in seconds since the epoch).
+        """
+        seen = set()
+        for kind, args in self._records():
+            if kind != 'file':
+                continue
+            h, t, filename = args
+            if (since is not None and t < since) or (until is not None and t >= until):
+                continue
+            # A hash keeps the time it was added when its file is renamed,
+            # so only the hashes in the range need to be remembered.
+            key = h.key()
+            if key not in seen:
+                seen.add(key)
+                yield h, t, filename
+
+    def find_hash(self, h):
+        """ Returns the (hash, time, filename) of the file recorded last with
+            the hash h, or None.
+        """
+        for kind, args in self._records():
+            if kind == 'file' and args[0] == h:
+                return args
+        return None
+
+    def links(self, h):
+        """ Returns the list of the links recorded for the hash h."""
+        links = list()
+        for kind, args in self._records():
+            if kind == 'link' and args[0] == h:
+                links.append(args[1])
+            elif kind == 'file' and args[0] == h:
+                # the links recorded before it belong to an earlier file.
+                break
+        links.reverse()
+        return links
+
+    def find_path(self, path):
+        """ Generator that yields the (hash, time, filename) of the last
+            record of the file path, or of each file in the directory path.
+        """
+        path = os.path.normpath(path)
+        seen = set()
+        for kind, args in self._records():
+            if kind != 'file':
+                continue
+            filename = args[2]
+            if rau.in_directory(filename, path) and filename not in seen:
+                seen.add(filename)
+                yield args
+
+    def close(self):
+        """ Closes the datafile."""
+        pass
+
+
+class SqliteQuery(Query):
+    """ Read only queries over the records of the 'sqlite' storage, using
+        the indexes of the database.
+    """
+    def __init__(self, datafilename, databasename):
+        Query.__init__(self, datafilename)
+        if not os.path.exists(databasename):
+            raise IOError("No such database: %s" % databasename)
+        self.db = sqlite3.connect(databasename)
+        # keep filenames as byte strings
+        self.db.text_factory = str
+
+    def _rows(self, cur):
+        for h, t, filename in cur:
+            yield rau.Hash.FromString(h), t, filename
+
+    def added(self, since=None, until=None):
+        if since is None:
+            since = -sys.maxint
+        if until is None:
+            until = sys.maxint
+        return self._rows(self.db.execute(
+                "SELECT hash, time, filename FROM hashes WHERE time >= ? AND time < ? "
+                "ORDER BY time DESC", (since, until)))
+
+    def find_hash(self, h):
+        cur = self.db.execute("SELECT hash, time, filename FROM hashes WHERE hash = ?", (str(h),))
+        return next(self._rows(cur), None)
+
+    def links(self, h):
+        cur = self.db.execute("SELECT linkname FROM links WHERE hash = ?", (str(h),))
+        return [row[0] for row in cur]
+
+    def find_path(self, path):
+        path = os.path.normpath(path)
+        # the files in the directory sort between path + '/' and path + '0'
+        return self._rows(self.db.execute(
+                "SELECT hash, time, filename FROM files WHERE filename = ? "
+                "OR (filename > ? AND filename < ?) ORDER BY filename",
+                (path, path.rstrip('/') + '/', path.rstrip('/') + '0')))
+
+    def close(self):
+        self.db.close()
+
+
+def write_record(fp, record, as_json=False, links=None):
+    """ Writes the (hash, time, filename) record to fp, in the format of the
+        datafile or as a JSON line.
+    """
+    h, t, filename = record
+    if as_json:
+        d = dict(hash=str(h), time=t, filename=filename,
+                 date=datetime.datetime.fromtimestamp(t).isoformat())
+        if links is not None:
+            d['links'] = links
+        fp.write(json.dumps(d, sort_keys=True))
+        fp.write("\n")
+        return
+    fp.write("%s %d %s\n" % (h, t, filename))
+    for link in links or ():
+        fp.write("LINK %s %s\n" % (h, link))
+
+
+def main():
+    """ Main function call for the program."""
+    parser = argparse.ArgumentParser(description='Recent Additions Directory query.')
+    parser.add_argument('datafile',
+            help='The datafile of the recent additions directory.')
+    parser.add_argument('--since', dest='since', type=parse_time, default=None,
+            help='Lists the files added at or after this time (seconds since the epoch, or YYYY-MM-DD[THH:MM:SS]).')
+    parser.add_argument('--until', dest='until', type=parse_time, default=None,
+            help='Lists the files added before this time.')
+    parser.add_argument('--hash', dest='hash', default=None,
+            help='Finds the file with this hash, given as in the datafile ("<partial shasum> <size>").')
+    parser.add_argument('--path', dest='path', default=None,
+            help='Finds the record of this file, or of the files in this directory.')
+    parser.add_argument('--links', dest='links', action='store_true', default=False,
+            help='Also lists the links of the file found with --hash.')
+    parser.add_argument('--json', dest='json', action='store_true', default=False,
+            help='Writes the results as JSON lines.')
+
+    options = parser.parse_args()
+    if options.hash is not None and options.path is not None:
+        parser.error("--hash and --path can not be used together")
+    if (options.hash is not None or options.path is not None) and (
+            options.since is not None or options.until is not None):
+        parser.error("--since and --until can not be used with --hash or --path")
+    if options.links and options.hash is None:
+        parser.error("--links can only be used with --hash")
+    h = None
+    if options.hash is not None:
+        try:
+            h = rau.Hash.FromString(options.hash)
+        except (ValueError, TypeError, rau.DataFileError):
+            parser.error("invalid --hash: %s" % options.hash)
+
+    # stop quietly when the output is closed, ie by head.
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    query = Query.Open(options.datafile)
+    try:
+        if h is not None:
+            record = query.find_hash(h)
+            if record is None:
+                sys.exit(1)
+            links = None
+            if options.links:
+                links = query.links(h)
+            write_record(sys.stdout, record, options.json, links)
+        elif options.path is not None:
+            for record in query.find_path(options.path):
+                write_record(sys.stdout, record, options.json)
+        else:
+            for record in query.added(options.since, options.until):
+                write_record(sys.stdout, record, options.json)
+    finally:
+        query.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -20,9 +20,29 @@ The format of the datafile is as thus;
     <hash> <time> <file>
     COLLISION <linkname> <r>
     LINK <hash> <linkname>
+    STAT <hash> <device> <inode> <mtime>
+    DIR <mtime> <directory>
+    SCAN <count>
+    CHECKPOINT <file>
 
 where hash is:
-    <partial shasum> <size>
+    [<algorithm>[@<samples>x<samplesize>]:]<partial shasum> <size>
+
+The algorithm is omitted for sha1, and the samples are only given for sampled
+fingerprints.
+
+The STAT records allow a renamed or moved file to be recognised from its
+inode, size and mtime without reading its contents.
+
+The DIR records hold the mtime a scanned directory had when it was last
+listed. A directory whose mtime is unchanged is not listed again, only its
+recorded subdirectories are scanned. The SCAN record holds the number of scans
+since the last full scan that recorded a changed directory (a scan that
+changes nothing writes no records).
+
+The CHECKPOINT records hold the last file checked by the scan of a scan
+directory, or the scan directory itself once its scan has finished, so an
+interrupted scan can be resumed with --resume.
 
 where parameters can be:
  * scan    - the directory to scan. This paramter can be used multiple times.
@@ -33,30 +53,166 @@ where parameters can be:
                 directory.
  * ignore  - a regular expression of files to ignore (ie, \.part$). This
                 parameter can be used multiple times.
+ * hash    - the algorithm the partial shasums of new files are made with,
+                one of sha1 (the default), md5, blake2b or xxh64. Records
+                made with a different algorithm keep working, but renamed
+                files are only recognised by their hash if it was made with
+                the current algorithm.
+ * hashbuf - the number of bytes read at a time when hashing (default 1MB).
+ * hashio  - how files are read when hashing, either 'readinto' (the
+                default) or 'mmap'.
+ * fingerprint - what part of a new file is hashed, either 'clip' (the first
+                shaclip bytes, the default) or 'sampled' (samples blocks of
+                samplesize bytes spread evenly from the head to the tail of
+                the file). Sampled fingerprints cost a few small reads per
+                file and also tell apart files sharing a long header.
+ * samples - the number of blocks hashed by a sampled fingerprint (default 3).
+ * samplesize - the size of the blocks of a sampled fingerprint
+                (default 4096).
+ * retention - the number of days a bucket directory is kept by
+                --reconcile, given as <directory> <days> (ie, day 14). This
+                parameter can be used multiple times, and directories without
+                a retention are kept forever.
+ * bucket  - the strftime format of a bucket directory new files are linked
+                into, relative to the target (ie, year/%Y). This parameter
+                can be used multiple times, the formats sorting in
+                chronological order. The bucket directories are kept in a
+                fixed directory (ie, year), so only the last component of
+                the format may use strftime. The default buckets are
+                month/%Y-%m, week/%Y-%U and day/%Y-%m-%d.
+ * shortcut - a link in the target to the bucket some days behind the
+                current time, given as <name> <format> <days> (ie,
+                Yesterday day/%Y-%m-%d 1). This parameter can be used
+                multiple times, and replaces the default shortcuts (Today,
+                Yesterday, This week, Last week and This month).
+ * materialize - which links of a new file are made, either 'all' (the
+                default) or 'retained' (only those in buckets within their
+                retention). The file records are the intent of the links
+                left out; --reconcile makes the ones whose bucket is within
+                its retention, ie after the retention was lengthened.
+ * prune   - a regular expression of directories that are not scanned
+                (ie, /\.git$). This parameter can be used multiple times.
+ * fullscan - every how many scans that recorded a changed directory all
+                of the directories are listed, even if their mtime is
+                unchanged (default 0, never).
+ * workers - the number of threads used to hash new files (default 1).
+ * batchsize - the number of records buffered before they are written to
+                the datafile (default 1, or 1000 for sqlite storage).
+ * batchtime - the number of seconds records are buffered at most before
+                they are written (default 5).
+ * storage - where the records are kept, either 'text' (appended to the
+                datafile, the default) or 'sqlite'. The records of a text
+                datafile are migrated the first time it is loaded with
+                'sqlite' storage.
+ * database - the SQLite database of the 'sqlite' storage (default is the
+                datafile name with '.sqlite' appended).
 """
 # ::AUTOFILL name::
 # ::AUTOFILL copyleft::
 # ::AUTOFILL license BSD::
 
 # ::REQUIRES: symlink support, zc.lockfile::
-
-# :: TODO Remove dead links::
-# :: TODO add inotify support, checking file modified and file added, file removed::
+# ::OPTIONAL: pyinotify (for --watch)::
 
 import argparse
 import datetime
 import binascii
 import hashlib
+import json
+import sqlite3
+import mmap
+import io
+import collections
+import csv
 import string
+import struct
+import signal
+import resource
 import time
 import sys
 import os
 import re
+import threading
 import zc.lockfile
-
-INT_PARAMETERS = ['minsize', 'shaclip']
-MULTI_PARAMETERS = ['scan', 'ignore']
-REGEX_PRARMETERS = ['ignore']
+from multiprocessing.pool import ThreadPool
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import pyblake2
+except ImportError:
+    pyblake2 = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+INT_PARAMETERS = ['minsize', 'shaclip', 'workers', 'hashbuf', 'samples', 'samplesize',
+                  'batchsize', 'batchtime', 'fullscan']
+MULTI_PARAMETERS = ['scan', 'ignore', 'prune', 'retention']
+LIST_PARAMETERS = ['bucket', 'shortcut']
+REGEX_PRARMETERS = ['ignore', 'prune']
+
+# number of files queued per hashing worker.
+QUEUE_FACTOR = 4
+
+# seconds a watched file must be left alone before it is checked.
+WATCH_SETTLE = 5
+
+# seconds between the checkpoints written by a scan.
+CHECKPOINT_TIME = 60
+
+# the hash algorithms that can be selected with the hash parameter.
+HASH_ALGORITHMS = {
+    'sha1': hashlib.sha1,
+    'md5': hashlib.md5,
+}
+if hasattr(hashlib, 'blake2b'):
+    HASH_ALGORITHMS['blake2b'] = hashlib.blake2b
+elif pyblake2 is not None:
+    HASH_ALGORITHMS['blake2b'] = pyblake2.blake2b
+if xxhash is not None:
+    HASH_ALGORITHMS['xxh64'] = xxhash.xxh64
+
+# the regular expression of a hash in the datafile.
+HASH_PATTERN = r"(?:[a-z0-9]+(?:@[0-9]+x[0-9]+)?:)?[0-9a-fA-F]+ [0-9]+"
+
+# the default number of bytes read at a time when hashing.
+HASHBUF = 1024 * 1024
+
+# the default (samples, samplesize) of sampled fingerprints.
+SAMPLING = (3, 4096)
+
+# the default number of seconds records are buffered before being written.
+BATCHTIME = 5
+
+# the number of seconds a small file may still be written to. A directory
+# with a small file modified more recently is listed again on the next scan.
+DIRECTORY_SETTLE = 24 * 60 * 60
+
+# the default formats of the bucket directories new files are linked into.
+# The formats must sort in chronological order.
+BUCKETS = ['month/%Y-%m', 'week/%Y-%U', 'day/%Y-%m-%d']
+
+# the default shortcuts of the target directory, as (name, bucket format,
+# days behind the current time).
+SHORTCUTS = [('Today', 'day/%Y-%m-%d', 0),
+             ('Yesterday', 'day/%Y-%m-%d', 1),
+             ('This week', 'week/%Y-%U', 0),
+             ('Last week', 'week/%Y-%U', 7),
+             ('This month', 'month/%Y-%m', 0)]
 
 global datafile
 
@@ -68,21 +224,55 @@ class DataFileError(Exception):
     line = ""
 
     def __init__(self, line):
-        self.line
+        self.line = line
 
     def __str__(self):
         return "Error in line: %s" % self.line
 
 
-class Hash:
-    """ A hash contains both the size and a partial shasum of a file."""
+class Hash(object):
+    """ A hash contains both the size and a partial shasum of a file.
+
+        The partial shasum is made with the algorithm of the hash, which is
+        sha1 for hashes that were recorded before the algorithm could be
+        selected. If the sampling of the hash is set, the partial shasum is a
+        sampled fingerprint of the file, see sampled_shasum.
+    """
+    __slots__ = ('partial_shasum', 'size', 'algorithm', 'sampling')
+
     shaclip = 0
+    hashname = 'sha1'
+    hashbuf = HASHBUF
+    use_mmap = False
+    hashsampling = None
+
+    def __init__(self):
+        self.algorithm = 'sha1'
+        self.sampling = None    # (samples, samplesize) of a sampled fingerprint
 
     @staticmethod
     def set_shaclip(clip):
         """ Sets the number of bytes read from a file before it is clipped."""
         Hash.shaclip = clip
 
+    @staticmethod
+    def set_engine(hashname='sha1', hashbuf=HASHBUF, use_mmap=False, sampling=None):
+        """ Sets the algorithm new hashes are made with, the number of bytes
+            read at a time and whether files are read with mmap.
+
+            If sampling is a (samples, samplesize) tuple, new hashes are
+            sampled fingerprints instead of clipped ones.
+        """
+        if hashname not in HASH_ALGORITHMS:
+            raise DataFileError("hash = %s (not one of %s)"
+                    % (hashname, ', '.join(sorted(HASH_ALGORITHMS))))
+        if sampling is not None and (sampling[0] < 1 or sampling[1] < 1):
+            raise DataFileError("samples = %d, samplesize = %d" % sampling)
+        Hash.hashname = hashname
+        Hash.hashbuf = hashbuf
+        Hash.use_mmap = use_mmap
+        Hash.hashsampling = sampling
+
     @staticmethod
     def FromFile(filename):
         """ Constructs a new hash from a filename."""
@@ -94,35 +284,107 @@ class Hash:
     def FromString(str):
         """ Constructs a new hash file from a string.
 
-            The format of the string is as this <partial shasum> <size>
+            The format of the string is as this
+            [<algorithm>[@<samples>x<samplesize>]:]<partial shasum> <size>
         """
         h = Hash()
         h._read_string(str)
         return h
 
+    @staticmethod
+    def FromKey(key):
+        """ Constructs a hash from the compact string returned by key."""
+        h = Hash()
+        if key[0] == '\1':
+            h.partial_shasum = key[1:-8]
+        else:
+            tag, sep, key = key[1:].partition(':')
+            h._read_tag(tag)
+            h.partial_shasum = key[:-8]
+        h.size = struct.unpack('>Q', key[-8:])[0]
+        return h
+
+    def key(self):
+        """ Returns a compact string identifying the hash. 
+
+            FORMAT: ('\\1' | '\\0' <tag> ':')<binary partial shasum><64 bit size>
+
+            The marker byte tells a sha1 key from a tagged one, whatever the
+            bytes of the shasum are.
+        """
+        key = self.partial_shasum + struct.pack('>Q', self.size)
+        tag = self.tag()
+        if tag == 'sha1':
+            return '\1' + key
+        return '\0' + tag + ':' + key
+
+    def tag(self):
+        """ Returns the algorithm and sampling of the hash.
+
+            FORMAT: <algorithm>[@<samples>x<samplesize>]
+        """
+        if self.sampling is None:
+            return self.algorithm
+        return "%s@%dx%d" % ((self.algorithm,) + self.sampling)
+
+    @property
+    def partial_shasum_hex(self):
+        return binascii.hexlify(self.partial_shasum)
+
     def _file(self, filename):
-        shasum = partial_shasum(filename, Hash.shaclip)
+        start = time.time()
+        if Hash.hashsampling is not None:
+            shasum = sampled_shasum(filename, Hash.hashsampling[0],
+                                    Hash.hashsampling[1], Hash.hashname)
+            self.sampling = Hash.hashsampling
+        else:
+            shasum = partial_shasum(filename, Hash.shaclip, Hash.hashname,
+                                    Hash.hashbuf, Hash.use_mmap)
+        self.algorithm = Hash.hashname
         self.size = os.path.getsize(filename)
-        self.partial_shasum_hex = shasum.hexdigest()
         self.partial_shasum = shasum.digest()
+        profile.timed('hash', start)
+        profile.count('hashed')
+        profile.count('bytes_hashed', min(self.size, self._length()))
+
+    def _length(self):
+        # The number of bytes of a file read by the current engine.
+        if Hash.hashsampling is not None:
+            return Hash.hashsampling[0] * Hash.hashsampling[1]
+        if Hash.shaclip <= 4096:
+            return self.size
+        return Hash.shaclip
 
     def _read_string(self, str):
-        m = re.match("([0-9a-fA-F]+) +([0-9]+)", str)
+        m = re.match("(?:([a-z0-9@]+):)?([0-9a-fA-F]+) +([0-9]+)", str)
         if m is None:
             raise ValueError("Invalid format", str)
-        self.partial_shasum_hex = m.group(1) 
-        self.partial_shasum = binascii.unhexlify(m.group(1))
-        self.size = int(m.group(2)) 
+        if m.group(1) is not None:
+            self._read_tag(m.group(1))
+        self.partial_shasum = binascii.unhexlify(m.group(2))
+        self.size = int(m.group(3)) 
+
+    def _read_tag(self, tag):
+        m = re.match("([a-z0-9]+)(?:@([0-9]+)x([0-9]+))?$", tag)
+        if m is None:
+            raise ValueError("Invalid format", tag)
+        self.algorithm = m.group(1)
+        if m.group(2) is not None:
+            self.sampling = (int(m.group(2)), int(m.group(3)))
 
     def __str__(self):
         """ Converts a hash object to a string.
 
-            FORMAT: <partial shasum> <size>
+            FORMAT: [<algorithm>[@<samples>x<samplesize>]:]<partial shasum> <size>
         """
-        return "%s %d" % (self.partial_shasum_hex, self.size)
+        tag = self.tag()
+        if tag == 'sha1':
+            return "%s %d" % (self.partial_shasum_hex, self.size)
+        return "%s:%s %d" % (tag, self.partial_shasum_hex, self.size)
 
     def __eq__(self, other):
-        return (self.partial_shasum, self.size) == (other.partial_shasum, other.size)
+        return ((self.partial_shasum, self.size, self.algorithm, self.sampling) ==
+                (other.partial_shasum, other.size, other.algorithm, other.sampling))
 
     def __cmp__(self, other):
         if self.partial_shasum == other.partial_shasum:
@@ -135,147 +397,450 @@ class Hash:
 
 
 
+def iter_records(fp):
+    """ Generator that parses the lines of the datafile fp.
+
+        Yields (kind, args, line) tuples where kind and args are one of:
+
+            'config', (key, value)
+            'file', (hash, time, filename)
+            'link', (hash, linkname)
+            'collision', (linkname, r)
+            'stat', (hash, (device, inode, size, mtime))
+            'directory', (directory, mtime)
+            'scan', count
+            'checkpoint', path
+    """
+    for line in fp:
+        if line.startswith("COLLISION"):
+            # Collision match record.
+            # format is: COLLISION <linkname> <r>
+            m = re.match(r"^COLLISION +(.+) +([0-9]+)$", line)
+            yield 'collision', (m.group(1), int(m.group(2))), line
+            continue
+        elif line.startswith("LINK"):
+            # Link record.
+            # format is: LINK <hash> <link>
+            m = re.match(r"^LINK +(%s) +(.+)$" % HASH_PATTERN, line)
+            yield 'link', (Hash.FromString(m.group(1)), m.group(2)), line
+            continue
+        elif line.startswith("STAT"):
+            # Stat record.
+            # format is: STAT <hash> <device> <inode> <mtime>
+            m = re.match(r"^STAT +(%s) +([0-9]+) +([0-9]+) +([0-9]+)$" % HASH_PATTERN, line)
+            h = Hash.FromString(m.group(1))
+            key = (int(m.group(2)), int(m.group(3)), h.size, int(m.group(4)))
+            yield 'stat', (h, key), line
+            continue
+        elif line.startswith("DIR "):
+            # Directory record.
+            # format is: DIR <mtime> <directory>
+            m = re.match(r"^DIR +(-?[0-9]+) +(.+)$", line)
+            yield 'directory', (m.group(2), int(m.group(1))), line
+            continue
+        elif line.startswith("SCAN "):
+            # Scan count record.
+            # format is: SCAN <count>
+            m = re.match(r"^SCAN +([0-9]+)$", line)
+            yield 'scan', int(m.group(1)), line
+            continue
+        elif line.startswith("CHECKPOINT "):
+            # Checkpoint record.
+            # format is: CHECKPOINT <file>
+            m = re.match(r"^CHECKPOINT +(.+)$", line)
+            yield 'checkpoint', m.group(1), line
+            continue
+        else:
+            m = re.match(r"^(%s) +([0-9]+) +(.+)$" % HASH_PATTERN, line)
+            if m is not None:
+                # file record 
+                # format is: <hash> <time> <filename>
+                h = Hash.FromString(m.group(1))
+                yield 'file', (h, int(m.group(2)), m.group(3)), line
+                continue
+            m = re.match(r"^(.+?)\s*=\s*(.+)$", line)
+            if m is not None:
+                # config parameter
+                # format is: <key> = <value>
+                yield 'config', (m.group(1), m.group(2).strip()), line
+                continue
+        raise ValueError("Invalid format", line)
+
+
+
 class Datafile:
     """ Storage class for the datafile."""
 
-    _hash_cache = None  # the hash being cached.
-    _cache = None       # the links, time data of the cache
+    lock = None
+    datafilefp = None
+    dry_run = False
+    closed = False
+    _buffer = ()
  
     @staticmethod
-    def Load(datafilename):
-        """ Loads the datafile into memory."""
+    def Load(datafilename, dry_run=False):
+        """ Loads the datafile into memory.
+
+            If the storage parameter is 'sqlite' a SqliteDatafile is returned
+            instead.
+
+            If dry_run is set, the records are only added to the loaded index
+            and nothing is written to the datafile.
+        """
         d = Datafile()
+        d.dry_run = dry_run
         d.lock = zc.lockfile.LockFile(datafilename + '.lock')
-        d.__load(datafilename)
+        d._load(datafilename)
+        if d.config.get('storage', 'text') == 'sqlite':
+            return SqliteDatafile.FromDatafile(d)
         return d
 
-    def __load(self, datafilename):
+    def _load(self, datafilename):
         # Load the datafile into memory.
         self.datafilename = datafilename
         self.config = dict()
         for m in MULTI_PARAMETERS:
             self.config[m] = set()
+        for m in LIST_PARAMETERS:
+            self.config[m] = list()
+        self.config_lines = list()
+        self.record_count = 0
         self.collisions = dict()
-        self.filenames = set()
-        self.hash_links = dict() # mapping of hashes to a tupple of (date, set of links).
+        # The index is kept compact for datafiles of millions of files: hashes
+        # are stored by their key, filenames in sets per directory, and only
+        # hashes with links (files above minsize) have a tuple of links.
+        self.directories = dict() # mapping of directories to sets of basenames.
+        self.hash_times = dict() # mapping of hash keys to times.
+        self.hash_links = dict() # mapping of hash keys to tuples of links.
+        self.stats = dict() # mapping of packed (device, inode, size, mtime) to hash keys.
+        self.directory_mtimes = dict() # mapping of scanned directories to mtimes.
+        self.subdirectory_names = dict() # mapping of scanned directories to sets of subdirectories.
+        self.scans = 0
+        checkpoints = list()
 
         self.datafilefp = fp = open(datafilename, 'r')
-        for line in fp:
-            if line.startswith("COLLISION"):
-                # Collision match record.
-                # format is: COLLISION <linkname> <r>
-                m = re.match(r"^COLLISION +(.+) +([0-9]+)$", line)
-                linkname = m.group(1)
-                r = int(m.group(2))
-                self.collisions[linkname] = r
-                continue
-            elif line.startswith("LINK"):
-                # Link record.
-                # format is: LINK <hash> <link>
-                m = re.match(r"^LINK +([0-9a-fA-F]+ [0-9]+) +(.+)$", line)
-                h = Hash.FromString(m.group(1))
-                link = m.group(2)
-                t, links = self.hash_links[h]
-                links.add(link)
+        self.truncated = None
+        line = None
+        for kind, args, line in iter_records(self._lines(fp)):
+            if kind == 'config':
+                key, value = args
+                if key in REGEX_PRARMETERS:
+                    value = re.compile(value)
+                if key in MULTI_PARAMETERS:
+                    self.config[key].add(value)
+                elif key in LIST_PARAMETERS:
+                    self.config[key].append(value)
+                elif key in INT_PARAMETERS:
+                    self.config[key] = int(value)
+                else:
+                    self.config[key] = value
+                self.config_lines.append(line)
                 continue
-            else:
-                m = re.match(r"^([0-9a-fA-F]+ [0-9]+) +([0-9]+) +(.+)$", line)
-                if m is not None:
-                    # file record 
-                    # format is: <hash> <time> <filename>
-                    h = Hash.FromString(m.group(1))
-                    t = int(m.group(2))
-                    filename = m.group(3) 
-                    self.filenames.add(filename)
-                    self.hash_links[h] = (t, set())
-                    continue;
-                m = re.match(r"^(.+?)\s*=\s*(.+)$", line)
-                if m is not None:
-                    # config parameter
-                    # format is: <key> = <value>
-                    key = m.group(1)
-                    value = m.group(2).strip()
-                    if key in REGEX_PRARMETERS:
-                        value = re.compile(value)
-                    if key in MULTI_PARAMETERS:
-                        self.config[key].add(value)
-                    elif key in INT_PARAMETERS:
-                        self.config[key] = int(value)
-                    else:
-                        self.config[key] = value
-                    continue
-            raise ValueError("Invalid format", line)
+            self.record_count += 1
+            if kind == 'file':
+                h, t, filename = args
+                self._add_file(filename, h.key(), t)
+            elif kind == 'link':
+                h, link = args
+                self._add_link(h.key(), link)
+            elif kind == 'collision':
+                linkname, r = args
+                self.collisions[linkname] = r
+            elif kind == 'stat':
+                h, key = args
+                self.stats[struct.pack('>QQQq', *key)] = h.key()
+            elif kind == 'directory':
+                directory, mtime = args
+                self._add_directory(directory, mtime)
+            elif kind == 'scan':
+                self.scans = args
+            elif kind == 'checkpoint':
+                checkpoints.append(args)
         fp.close()
+
+        if self.truncated is not None and not self.dry_run:
+            # Drop the record an interrupted write left behind.
+            offset, record = self.truncated
+            sys.stderr.write("%s: dropped truncated record: %s\n" % (datafilename, record))
+            fp = open(datafilename, 'r+')
+            fp.truncate(offset)
+            fp.close()
         self.datafilefp = open(datafilename, 'a')
+        if line is not None and not line.endswith("\n") and not self.dry_run:
+            # a parameter without a newline
+            self.datafilefp.write("\n")
+        self._configure()
+        self.checkpoints = dict() # mapping of scan directories to checkpoints.
+        for path in checkpoints:
+            root = self._checkpoint_root(path)
+            if root is not None:
+                self.checkpoints[root] = path
+
+    def _lines(self, fp):
+        # Yields the lines of the datafile, except for a last line without a
+        # newline that is not a parameter, which is recorded in truncated.
+        offset = 0
+        for line in fp:
+            if not line.endswith("\n"):
+                try:
+                    kind, args, line = next(iter_records([line]))
+                except (ValueError, AttributeError):
+                    kind = None
+                if kind != 'config':
+                    self.truncated = (offset, line)
+                    return
+            offset += len(line)
+            yield line
+
+    def _configure(self):
+        # Prepare the loaded parameters for use.
+        self.ignore_regex = combine_regexes(self.config['ignore'])
+        self.prune_regex = combine_regexes(self.config['prune'])
+        self.scan_roots = sorted(os.path.abspath(d) for d in self.config['scan'])
+        self.retention = dict()
+        for value in self.config['retention']:
+            m = re.match(r"^(.+?)\s+([0-9]+)$", value)
+            if m is None:
+                raise DataFileError("retention = %s" % value)
+            self.retention[m.group(1)] = int(m.group(2))
+        self.buckets = self.config['bucket'] or BUCKETS
+        for format in self.buckets:
+            # reconcile and the retention find the buckets in their directory
+            top = os.path.dirname(format)
+            if not top or '%' in top:
+                raise DataFileError("bucket = %s (the directory of the buckets must be a fixed name)" % format)
+        self.shortcuts = list()
+        for value in self.config['shortcut']:
+            m = re.match(r"^(.+?)\s+(\S+)\s+([0-9]+)$", value)
+            if m is None:
+                raise DataFileError("shortcut = %s" % value)
+            self.shortcuts.append((m.group(1), m.group(2), int(m.group(3))))
+        if not self.config['shortcut']:
+            self.shortcuts = SHORTCUTS
+        materialize = self.config.get('materialize', 'all')
+        if materialize not in ('all', 'retained'):
+            raise DataFileError("materialize = %s" % materialize)
+        self.lazy = materialize == 'retained'
+        self.batchsize = self.config.get('batchsize', 1)
+        self.batchtime = self.config.get('batchtime', BATCHTIME)
+        self._buffer = list()
+        self._flushed = time.time()
+
+
+    def _add_file(self, filename, key, t):
+        # Adds a file record to the index.
+        head, sep, tail = filename.rpartition('/')
+        names = self.directories.get(head)
+        if names is None:
+            names = self.directories[head] = set()
+        names.add(tail)
+        self.hash_times[key] = t
+        # reset links (as the links either do not exist or have been deleted)
+        self.hash_links.pop(key, None)
+
+    def _add_link(self, key, link):
+        # Adds a link record to the index.
+        links = self.hash_links.get(key, ())
+        if link not in links:
+            self.hash_links[key] = links + (link,)
+
+
+    def _add_directory(self, directory, mtime):
+        # Adds a directory record to the index.
+        self.directory_mtimes[directory] = mtime
+        head, tail = os.path.split(directory)
+        names = self.subdirectory_names.get(head)
+        if names is None:
+            names = self.subdirectory_names[head] = set()
+        names.add(tail)
 
 
     def filename_is_unique(self, filename):
         """ Returns true if the filename does not exist in the
             datafile.
         """
-        return filename not in self.filenames
+        head, sep, tail = filename.rpartition('/')
+        names = self.directories.get(head)
+        return names is None or tail not in names
+
+
+    def is_scanned(self, path, isdir=False):
+        """ Returns true if the path is in one of the scan directories, and
+            not in a pruned directory. If isdir is set, the path is a
+            directory that must not be pruned itself either.
+        """
+        for root in self.scan_roots:
+            if not in_directory(path, root):
+                continue
+            if self.prune_regex is None:
+                return True
+            # the directories walked from the root to the path
+            d = path if isdir else os.path.dirname(path)
+            while len(d) > len(root):
+                if self.prune_regex.search(d):
+                    break
+                parent = os.path.dirname(d)
+                if parent == d:
+                    break
+                d = parent
+            else:
+                return True
+        return False
+
+
+    def stat_hash(self, st):
+        """ Returns the hash of the file recorded with the device, inode, size
+            and mtime of the stat result st, or None if there is no such file.
+        """
+        key = self.stats.get(struct.pack('>QQQq', *stat_key(st)))
+        if key is None:
+            return None
+        return Hash.FromKey(key)
 
 
     def hash_exists(self, h):
         """ Returns true if the given hash shasum exist in the datafile.
         """
-        try:
-            # save cache because the next thing we will probably do with this
-            # is retrieve the data from it.
-            self._cache = self.hash_links[h]
-            self._hash_cache = h
-            return True
-        except KeyError:
-            # faster than doing two lookups.
-            self._hash_cache = None
-            return False
+        return h.key() in self.hash_times
 
 
-    def append_filehash(self, filename, h, t):
+    def append_filehash(self, filename, h, t, st=None):
         """ Appends the filename, hash and time of a file into the datafile.
+
+            If the stat result st of the file is given, it is recorded so the
+            file can be found by stat_hash if it is renamed.
         """
         # add to maps
-        self.filenames.add(filename)
         intt = int(time.mktime(t))
-        # reset links (as the links either do not exist or have been deleted)
-        # clear cache (to prevent mis matches)
-        self._cache = (intt, set())
-        self._hash_cache = h 
-        self.hash_links[h] = self._cache
+        self._add_file(filename, h.key(), intt)
         # append to datafile
-        self.datafilefp.write("%s %d %s\n" % (h, intt, filename))
-        self.datafilefp.flush()
+        record = "%s %d %s\n" % (h, intt, filename)
+        if st is not None:
+            key = stat_key(st)
+            self.stats[struct.pack('>QQQq', *key)] = h.key()
+            record += "STAT %s %d %d %d\n" % (h, key[0], key[1], key[3])
+        self._write(record)
 
 
     def add_link(self, h, linkname):
         """ Adds the linkname (with a hash) to the datafile."""
-        links = self.get_links(h)
-        links.add(linkname)
-        
-        self.datafilefp.write("LINK %s %s\n" % (h, linkname))
-        self.datafilefp.flush()
+        self._add_link(h.key(), linkname)
+        self._write("LINK %s %s\n" % (h, linkname))
 
 
     def get_links(self, h):
         """ Returns a set of links for a given hash."""
-        if self._hash_cache is not None and self._hash_cache == h:
-            t, links = self._cache
-        else:
-            # populate cache
-            self._hash_cache = h
-            t, links = self._cache = self.hash_links[h]
-        return links
+        return set(self.hash_links.get(h.key(), ()))
 
 
     def get_time(self, h):
         """ Returns the time a given hash was added to the datafile."""
-        if self._hash_cache is not None and self._hash_cache == h:
-            t, links = self._cache
-        else:
-            # populate cache
-            self._hash_cache = h
-            t, links = self._cache = self.hash_links[h]
-        return time.localtime(t)
+        return time.localtime(self.hash_times[h.key()])
+
+
+    def directory_mtime(self, directory):
+        """ Returns the mtime the directory had when it was last listed, or
+            None if it was never recorded.
+        """
+        return self.directory_mtimes.get(directory)
+
+
+    def subdirectories(self, directory):
+        """ Returns the sorted list of the recorded subdirectories of
+            directory.
+        """
+        names = self.subdirectory_names.get(os.path.normpath(directory), ())
+        return [os.path.join(directory, name) for name in sorted(names)]
+
+
+    def set_directory_mtime(self, directory, mtime):
+        """ Records the mtime of a listed directory."""
+        self._add_directory(directory, mtime)
+        self._write("DIR %d %s\n" % (mtime, directory))
+
+
+    def _checkpoint_root(self, path):
+        # Returns the scan directory a checkpoint belongs to, as given by the
+        # parameter or as an absolute path.
+        roots = [r for r in set(self.config['scan']) | set(self.scan_roots)
+                 if in_directory(path, r)]
+        if not roots:
+            return None
+        return max(roots, key=len)
+
+
+    def is_scan_root(self, root):
+        """ Returns true if root is one of the scan directories."""
+        return root in self.config['scan'] or root in self.scan_roots
+
+
+    def checkpoint(self, root):
+        """ Returns the last file checked by the scan of the scan directory
+            root, root itself if its scan has finished, or None.
+        """
+        return self.checkpoints.get(root)
+
+
+    def set_checkpoint(self, root, path):
+        """ Records path as the last file checked by the scan of root."""
+        self.checkpoints[root] = path
+        self._write("CHECKPOINT %s\n" % path)
+
+
+    def scan_count(self):
+        """ Returns the number of scans since the last full scan."""
+        return self.scans
+
+
+    def set_scan_count(self, count):
+        """ Records the number of scans since the last full scan."""
+        self.scans = count
+        self._write("SCAN %d\n" % count)
+
+
+    def live_links(self):
+        """ Returns a dict mapping the recorded links of every hash to the
+            last file recorded with that hash.
+        """
+        files = dict()  # hash key -> filename of its last record
+        links = dict()  # hash key -> links recorded after it
+        fp = open(self.datafilename, 'r')
+        for kind, args, line in iter_records(fp):
+            if kind == 'file':
+                h, t, filename = args
+                files[h.key()] = filename
+                links[h.key()] = list()
+            elif kind == 'link':
+                h, link = args
+                links[h.key()].append(link)
+        fp.close()
+        return dict((link, files[key])
+                    for key, l in links.iteritems() for link in l)
+
+
+    def file_hashes(self):
+        """ Returns a dict mapping every recorded file to the hash of its
+            last record.
+        """
+        files = dict()
+        fp = open(self.datafilename, 'r')
+        for kind, args, line in iter_records(fp):
+            if kind == 'file':
+                h, t, filename = args
+                files[filename] = h
+        fp.close()
+        return files
+
+
+    def index_sizes(self):
+        """ Returns a list of (name, number) of the records in the index."""
+        return [('files', sum(len(names) for names in self.directories.itervalues())),
+                ('directories', len(self.directories)),
+                ('hashes', len(self.hash_times)),
+                ('links', sum(len(links) for links in self.hash_links.itervalues())),
+                ('collisions', len(self.collisions)),
+                ('stats', len(self.stats)),
+                ('directory_mtimes', len(self.directory_mtimes))]
         
 
     def get_linkname_collision(self, linkname):
@@ -291,46 +856,619 @@ class Datafile:
 
     def set_linkname_collision(self, linkname, r):
         """ Sets the r value of a given linkname collision in the datafile."""
-        self.datafilefp.write("COLLISION %s %d\n" %(linkname, r))
-        self.datafilefp.flush()
+        self._write("COLLISION %s %d\n" %(linkname, r))
         self.collisions[linkname] = r
 
 
     def in_ignorelist(self, filename):
         """ Returns true if the filename matches a regex in the ignore list."""
-        for r in self.config['ignore']:
-            if r.search(filename):
-                return True
-        return False
+        return self.ignore_regex is not None and self.ignore_regex.search(filename) is not None
+
+
+    def _write(self, record):
+        # Buffers the record, writing the buffer once it holds batchsize
+        # records or batchtime seconds have passed.
+        if self.dry_run:
+            return
+        self._buffer.append(record)
+        if (len(self._buffer) >= self.batchsize or
+                time.time() - self._flushed >= self.batchtime):
+            self.flush()
+
+
+    def flush(self):
+        """ Makes sure the records appended so far are written."""
+        if self._buffer:
+            self.datafilefp.write(''.join(self._buffer))
+            del self._buffer[:]
+        self.datafilefp.flush()
+        self._flushed = time.time()
+
+
+    def close(self):
+        """ Writes the buffered records, syncs and closes the datafile and
+            removes the lock.
+        """
+        if self.datafilefp is not None and not self.datafilefp.closed:
+            self.flush()
+            os.fsync(self.datafilefp.fileno())
+            self.datafilefp.close()
+        # Remove the lock (unless it was handed over to another Datafile)
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
+        self.closed = True
+
+
+    def compact(self):
+        """ Rewrites the datafile, keeping only the parameters and the live
+            records. A file record is live if it is the last record of a file
+            that still exists, the links and stat of a live file record are
+            kept, and the last collision, DIR record and SCAN record of each
+            existing directory is kept, as is the last CHECKPOINT record of
+            each scan directory.
+
+            The records loaded into memory are not updated.
+
+            Returns a tuple of the number of bytes and records removed.
+        """
+        config = list()      # indexes of the parameters
+        last_file = dict()   # filename -> index of its last file record
+        last_hash = dict()   # hash -> index of its last file record
+        hash_links = dict()  # hash -> mapping of its links to their index
+        last_collision = dict() # linkname -> index of its last collision
+        last_stat = dict()   # stat key -> (index, index of its file record)
+        last_directory = dict() # directory -> index of its last record
+        last_scan = None
+        last_checkpoint = dict() # scan directory -> index of its last checkpoint
+
+        count = 0
+        file_index = None
+        fp = open(self.datafilename, 'r')
+        for i, (kind, args, line) in enumerate(iter_records(fp)):
+            count += 1
+            if kind == 'config':
+                config.append(i)
+            elif kind == 'file':
+                h, t, filename = args
+                last_file[filename] = i
+                last_hash[h] = i
+                hash_links[h] = dict()
+                file_index = i
+            elif kind == 'link':
+                h, link = args
+                hash_links[h].setdefault(link, i)
+            elif kind == 'collision':
+                linkname, r = args
+                last_collision[linkname] = i
+            elif kind == 'stat':
+                h, key = args
+                # stat records follow the record of their file
+                last_stat[key] = (i, file_index)
+            elif kind == 'directory':
+                directory, mtime = args
+                last_directory[directory] = i
+            elif kind == 'scan':
+                last_scan = i
+            elif kind == 'checkpoint':
+                root = self._checkpoint_root(args)
+                if root is not None:
+                    last_checkpoint[root] = i
+        fp.close()
+
+        keep = set(config)
+        for filename, i in last_file.iteritems():
+            if os.path.lexists(filename):
+                keep.add(i)
+        for h, i in last_hash.iteritems():
+            if i in keep:
+                keep.update(hash_links[h].itervalues())
+        for linkname, i in last_collision.iteritems():
+            if os.path.isdir(os.path.dirname(linkname)):
+                keep.add(i)
+        for i, file_index in last_stat.itervalues():
+            if file_index in keep:
+                keep.add(i)
+        for directory, i in last_directory.iteritems():
+            if os.path.isdir(directory):
+                keep.add(i)
+        if last_scan is not None:
+            keep.add(last_scan)
+        keep.update(last_checkpoint.itervalues())
+
+        size = os.path.getsize(self.datafilename)
+        fp = open(self.datafilename, 'r')
+        self._rewrite(line for i, line in enumerate(fp) if i in keep)
+        fp.close()
+        return size - os.path.getsize(self.datafilename), count - len(keep)
+
+
+    def _rewrite(self, lines):
+        # Atomically replaces the datafile with the given lines.
+        self.flush()
+        tmpname = self.datafilename + '.tmp'
+        fp = open(tmpname, 'w')
+        for line in lines:
+            fp.write(line.rstrip("\n") + "\n")
+        fp.flush()
+        os.fsync(fp.fileno())
+        fp.close()
+        self.datafilefp.close()
+        os.rename(tmpname, self.datafilename)
+        self.datafilefp = open(self.datafilename, 'a')
+
     
     def __del__(self):
-        # Close the datafile
-        self.datafilefp.close()
-        # Remove the lock
-        self.lock.close()
+        # a closed datafile needs no module globals during interpreter teardown
+        if not self.closed:
+            self.close()
+
+
+class SqliteDatafile(Datafile):
+    """ Storage class for a datafile whose records are kept in an indexed
+        SQLite database.
+
+        The datafile itself only holds the parameters. Any records found in
+        it are migrated into the database when it is loaded, and a copy of
+        the original datafile is kept with '.text' appended to its name.
+    """
+
+    # default number of changes made before they are committed.
+    COMMIT_INTERVAL = 1000
+
+    db = None
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            filename TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            time INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+        CREATE TABLE IF NOT EXISTS hashes (
+            hash TEXT PRIMARY KEY,
+            time INTEGER NOT NULL,
+            filename TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS hashes_time ON hashes (time);
+        CREATE TABLE IF NOT EXISTS links (
+            hash TEXT NOT NULL,
+            linkname TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS links_hash ON links (hash);
+        CREATE TABLE IF NOT EXISTS collisions (
+            linkname TEXT PRIMARY KEY,
+            r INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS stats (
+            device INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            hash TEXT NOT NULL,
+            PRIMARY KEY (device, inode, size, mtime)
+        );
+        CREATE TABLE IF NOT EXISTS directory_mtimes (
+            directory TEXT PRIMARY KEY,
+            parent TEXT NOT NULL,
+            mtime INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS directory_mtimes_parent ON directory_mtimes (parent);
+        CREATE TABLE IF NOT EXISTS state (
+            name TEXT PRIMARY KEY,
+            value
+        );
+    """
+
+    @staticmethod
+    def FromDatafile(d):
+        """ Opens the database of the loaded text datafile d, migrating any
+            records found in d into it.
+
+            A dry run uses an in-memory database if the database does not
+            exist yet, and never commits.
+        """
+        s = SqliteDatafile()
+        s.dry_run = d.dry_run
+        s.datafilename = d.datafilename
+        s.config = d.config
+        s.config_lines = d.config_lines
+        s._configure()
+        s.batchsize = d.config.get('batchsize', SqliteDatafile.COMMIT_INTERVAL)
+        s.lock, d.lock = d.lock, None
+        d.close()
+        databasename = d.config.get('database', d.datafilename + '.sqlite')
+        if s.dry_run and not os.path.exists(databasename):
+            databasename = ':memory:'
+        s._open(databasename)
+        # the number of records read, ie migrated, by this load
+        s.record_count = d.record_count
+        if d.record_count > 0:
+            s._migrate()
+        return s
+
+    def _open(self, databasename):
+        self.datafilefp = open(self.datafilename, 'a')
+        self.databasename = databasename
+        self.db = sqlite3.connect(databasename)
+        # keep filenames as byte strings
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.executescript(self.SCHEMA)
+        self._changes = 0
+
+    def _migrate(self):
+        # Move the records of the text datafile into the database.
+        fp = open(self.datafilename, 'r')
+        for kind, args, line in iter_records(fp):
+            if kind == 'file':
+                h, t, filename = args
+                self._insert_file(filename, h, t)
+            elif kind == 'link':
+                h, link = args
+                self.db.execute("INSERT INTO links VALUES (?, ?)", (str(h), link))
+            elif kind == 'collision':
+                linkname, r = args
+                self.db.execute("INSERT OR REPLACE INTO collisions VALUES (?, ?)", (linkname, r))
+            elif kind == 'stat':
+                h, key = args
+                self._insert_stat(h, key)
+            elif kind == 'directory':
+                directory, mtime = args
+                self._insert_directory(directory, mtime)
+            elif kind == 'scan':
+                self._set_state('scans', args)
+            elif kind == 'checkpoint':
+                root = self._checkpoint_root(args)
+                if root is not None:
+                    self._set_state('checkpoint ' + root, args)
+        fp.close()
+        if self.dry_run:
+            return
+        self.db.commit()
+
+        # Keep the original and replace it with the parameters only.
+        backup = self.datafilename + '.text'
+        if os.path.lexists(backup):
+            os.remove(backup)
+        os.link(self.datafilename, backup)
+        self._rewrite(self.config_lines)
+
+    def _insert_file(self, filename, h, intt):
+        hs = str(h)
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (filename, hs, intt))
+        self.db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)", (hs, intt, filename))
+        # reset links (as the links either do not exist or have been deleted)
+        self.db.execute("DELETE FROM links WHERE hash = ?", (hs,))
+
+    def _insert_stat(self, h, key):
+        self.db.execute("INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?, ?)", key + (str(h),))
+
+    def _insert_directory(self, directory, mtime):
+        self.db.execute("INSERT OR REPLACE INTO directory_mtimes VALUES (?, ?, ?)",
+                (directory, os.path.dirname(directory), mtime))
+
+    def _get_state(self, name, default=None):
+        row = self.db.execute("SELECT value FROM state WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def _set_state(self, name, value):
+        self.db.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (name, value))
+
+    def _changed(self):
+        # Commits the changes every batchsize calls or batchtime seconds.
+        self._changes += 1
+        if (self._changes >= self.batchsize or
+                time.time() - self._flushed >= self.batchtime):
+            self.flush()
+
+    def filename_is_unique(self, filename):
+        cur = self.db.execute("SELECT 1 FROM files WHERE filename = ?", (filename,))
+        return cur.fetchone() is None
+
+    def stat_hash(self, st):
+        cur = self.db.execute("SELECT hash FROM stats WHERE device = ? AND inode = ? AND size = ? AND mtime = ?",
+                stat_key(st))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return Hash.FromString(row[0])
+
+    def hash_exists(self, h):
+        return self._hash_time(h) is not None
+
+    def _hash_time(self, h):
+        cur = self.db.execute("SELECT time FROM hashes WHERE hash = ?", (str(h),))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def append_filehash(self, filename, h, t, st=None):
+        self._insert_file(filename, h, int(time.mktime(t)))
+        if st is not None:
+            self._insert_stat(h, stat_key(st))
+        self._changed()
+
+    def add_link(self, h, linkname):
+        self.db.execute("INSERT INTO links VALUES (?, ?)", (str(h), linkname))
+        self._changed()
+
+    def get_links(self, h):
+        cur = self.db.execute("SELECT linkname FROM links WHERE hash = ?", (str(h),))
+        return set(row[0] for row in cur)
+
+    def get_time(self, h):
+        return time.localtime(self._hash_time(h))
+
+    def directory_mtime(self, directory):
+        cur = self.db.execute("SELECT mtime FROM directory_mtimes WHERE directory = ?", (directory,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def subdirectories(self, directory):
+        cur = self.db.execute("SELECT directory FROM directory_mtimes WHERE parent = ?",
+                (os.path.normpath(directory),))
+        return [os.path.join(directory, os.path.basename(row[0])) for row in sorted(cur)]
+
+    def set_directory_mtime(self, directory, mtime):
+        self._insert_directory(directory, mtime)
+        self._changed()
+
+    def checkpoint(self, root):
+        return self._get_state('checkpoint ' + root)
+
+    def set_checkpoint(self, root, path):
+        self._set_state('checkpoint ' + root, path)
+        self._changed()
+
+    def scan_count(self):
+        return self._get_state('scans', 0)
+
+    def set_scan_count(self, count):
+        self._set_state('scans', count)
+        self._changed()
+
+    def live_links(self):
+        cur = self.db.execute("SELECT linkname, filename FROM links JOIN hashes USING (hash)")
+        return dict(cur)
+
+    def file_hashes(self):
+        cur = self.db.execute("SELECT filename, hash FROM files")
+        return dict((filename, Hash.FromString(h)) for filename, h in cur)
+
+    def index_sizes(self):
+        return [(table, self.db.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0])
+                for table in ('files', 'hashes', 'links', 'collisions', 'stats', 'directory_mtimes')]
+
+    def get_linkname_collision(self, linkname):
+        cur = self.db.execute("SELECT r FROM collisions WHERE linkname = ?", (linkname,))
+        row = cur.fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def set_linkname_collision(self, linkname, r):
+        self.db.execute("INSERT OR REPLACE INTO collisions VALUES (?, ?)", (linkname, r))
+        self._changed()
+
+    def flush(self):
+        if self.db is not None and not self.dry_run:
+            self.db.commit()
+        self._changes = 0
+        self._flushed = time.time()
+
+    def compact(self):
+        """ Removes the records of files that no longer exist, the links and
+            stats of their hashes and the collisions and mtimes of removed
+            directories, then vacuums the database.
+
+            Returns a tuple of the number of bytes and records removed.
+        """
+        tables = ('files', 'hashes', 'links', 'collisions', 'stats', 'directory_mtimes')
+
+        def count():
+            return sum(self.db.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0]
+                        for table in tables)
+
+        def size():
+            return os.path.getsize(self.databasename)
+
+        self.db.commit()
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        before = (size(), count())
+        cur = self.db.execute("SELECT filename FROM files")
+        missing = [(row[0],) for row in cur if not os.path.lexists(row[0])]
+        self.db.executemany("DELETE FROM files WHERE filename = ?", missing)
+        # the links of a hash belong to the last file with that hash
+        self.db.executescript("""
+            DELETE FROM links WHERE hash IN (SELECT hash FROM hashes
+                WHERE filename NOT IN (SELECT filename FROM files));
+            DELETE FROM hashes WHERE filename NOT IN (SELECT filename FROM files);
+            INSERT OR IGNORE INTO hashes SELECT hash, time, filename FROM files;
+            DELETE FROM stats WHERE hash NOT IN (SELECT hash FROM hashes);
+        """)
+        cur = self.db.execute("SELECT linkname FROM collisions")
+        removed = [(row[0],) for row in cur if not os.path.isdir(os.path.dirname(row[0]))]
+        self.db.executemany("DELETE FROM collisions WHERE linkname = ?", removed)
+        cur = self.db.execute("SELECT directory FROM directory_mtimes")
+        removed = [(row[0],) for row in cur if not os.path.isdir(row[0])]
+        self.db.executemany("DELETE FROM directory_mtimes WHERE directory = ?", removed)
+        self.db.commit()
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.db.execute("VACUUM")
+        return before[0] - size(), before[1] - count()
+
+    def close(self):
+        if self.db is not None:
+            # Commit and close the database
+            if self.dry_run:
+                self.db.rollback()
+            else:
+                self.db.commit()
+            self.db.close()
+            self.db = None
+        Datafile.close(self)
             
 
-def partial_shasum(filename, clip):
+def combine_regexes(regexes):
+    """ Combines the compiled regexes into a single regex matching any of
+        them, or returns None if there are none.
+
+        The regexes should not use numbered backreferences.
+    """
+    if not regexes:
+        return None
+    return re.compile('|'.join('(?:%s)' % r.pattern for r in regexes))
+
+
+def peak_memory():
+    """ Returns the peak resident set size of the process in kilobytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Profile:
+    """ Collects the time spent in each phase of a run and the counts of
+        the files and bytes handled.
+
+        The hash phase is the sum of the time spent by each worker, so with
+        more than one worker it can be longer than the run itself.
+    """
+    PHASES = ['load', 'walk', 'hash', 'link', 'write']
+
+    def __init__(self):
+        self.start = time.time()
+        self.times = dict((phase, 0.0) for phase in self.PHASES)
+        self.counts = dict()
+        self.lock = threading.Lock()
+
+    def timed(self, phase, start):
+        """ Adds the time since start to the phase."""
+        seconds = time.time() - start
+        with self.lock:
+            self.times[phase] += seconds
+
+    def count(self, name, n=1):
+        """ Adds n to the count name."""
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def walked(self, iterable):
+        """ Generator that yields the items of iterable, adding the time
+            spent producing them to the walk phase.
+        """
+        it = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.timed('walk', start)
+                return
+            self.timed('walk', start)
+            yield item
+
+    def report(self):
+        """ Returns a dict of the run time, phase times, counts and hashing
+            throughput.
+        """
+        megabytes = self.counts.get('bytes_hashed', 0) / (1024.0 * 1024.0)
+        seconds = max(time.time() - self.start, 0.001)
+        return dict(seconds=seconds,
+                    phases=dict(self.times),
+                    counts=dict(self.counts),
+                    hash_mb_per_sec=megabytes / max(self.times['hash'], 0.001),
+                    mb_per_sec=megabytes / seconds)
+
+
+profile = Profile()
+
+
+def stat_key(st):
+    """ Returns the (device, inode, size, mtime) key of a stat result."""
+    return (st.st_dev, st.st_ino, st.st_size, int(st.st_mtime))
+
+
+def partial_shasum(filename, clip, algorithm='sha1', bufsize=HASHBUF, use_mmap=False):
     """ Preforms a partial shasum for a given filename, clipping the file at
-        clip bytes.
+        clip bytes. A clip of 4096 bytes or less hashes the whole file.
+
+        The file is read bufsize bytes at a time into a reused buffer, or if
+        use_mmap is set, the clipped part of the file is mapped into memory
+        and hashed without copying.
+
+        Returns the hash object of the given algorithm.
     """
     # ::TESTED 20101218 21:42 ::
-    s = hashlib.sha1()
-    fp = open(filename, 'rb')
+    s = HASH_ALGORITHMS[algorithm]()
+    fp = io.open(filename, 'rb', buffering=0)
+    try:
+        if clip <= 4096:
+            clip = os.fstat(fp.fileno()).st_size
+
+        if use_mmap:
+            length = min(clip, os.fstat(fp.fileno()).st_size)
+            if length > 0:
+                m = mmap.mmap(fp.fileno(), length, access=mmap.ACCESS_READ)
+                try:
+                    s.update(m)
+                finally:
+                    m.close()
+            return s
+
+        buf = bytearray(max(min(bufsize, clip), 1))
+        view = memoryview(buf)
+        remaining = clip
+        while remaining > 0:
+            n = fp.readinto(view[:min(remaining, len(buf))])
+            # EOF
+            if not n:
+                break
+            s.update(buffer(buf, 0, n))
+            remaining -= n
+    finally:
+        fp.close()
+    return s
 
-    while True:
-        # end of clipping boundary
-        if fp.tell() < clip - 4096:
-            b = fp.read(clip - fp.tell())
-            s.update(b)
-            break
-        b = fp.read(4096)
-        s.update(b)
-        # EOF
-        if len(b) < 4096:
-            break; 
-
-    fp.close()
+
+def sampled_shasum(filename, samples, samplesize, algorithm='sha1'):
+    """ Preforms a sampled fingerprint of a given filename, hashing samples
+        blocks of samplesize bytes at offsets spread evenly from the head to
+        the tail of the file. Files no larger than the samples are hashed
+        whole.
+
+        Returns the hash object of the given algorithm.
+    """
+    s = HASH_ALGORITHMS[algorithm]()
+    fp = io.open(filename, 'rb', buffering=0)
+    try:
+        size = os.fstat(fp.fileno()).st_size
+        if size <= samples * samplesize:
+            offsets = [0]
+            samplesize = size
+        elif samples == 1:
+            offsets = [0]
+        else:
+            offsets = [(size - samplesize) * i // (samples - 1) for i in xrange(samples)]
+
+        buf = bytearray(max(samplesize, 1))
+        view = memoryview(buf)
+        for offset in offsets:
+            fp.seek(offset)
+            n = 0
+            while n < samplesize:
+                r = fp.readinto(view[n:samplesize])
+                # EOF (the file was truncated)
+                if not r:
+                    break
+                n += r
+            s.update(buffer(buf, 0, n))
+    finally:
+        fp.close()
     return s
 
 
@@ -342,6 +1480,302 @@ def locate(root):
             yield os.path.join(path, basename)
 
 
+class DirEntry:
+    """ A minimal stand in for the entries of os.scandir, used when the
+        scandir module is not available.
+    """
+    def __init__(self, path, name):
+        self.name = name
+        self.path = os.path.join(path, name)
+        self._stat = None
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+def list_directory(path):
+    """ Returns the entries of the directory path, sorted by name."""
+    if scandir is not None:
+        entries = list(scandir(path))
+    else:
+        entries = [DirEntry(path, name) for name in os.listdir(path)]
+    entries.sort(key=lambda e: e.name)
+    return entries
+
+
+def walk_position(root, path, isdir=True):
+    """ Returns a key of the path in root, that sorts in the order walk
+        lists the directories and files of root in.
+    """
+    root = os.path.abspath(root)
+    path = os.path.abspath(path)
+    key = [(1, name) for name in path[len(root):].split('/') if name]
+    if not isdir:
+        # the files of a directory are listed before its subdirectories.
+        key[-1] = (0, key[-1][1])
+    return key
+
+
+def walk(root, prune=None, ignore=None, minsize=-1, scan=None, after=None):
+    """ Generator that recursivly lists the (filename, stat) of the files in
+        a given directory, in a sorted order.
+
+        Directories matching the prune regex are not entered, files matching
+        the ignore regex are skipped without a stat, and files that are not
+        larger than minsize bytes are skipped. Like os.walk, symbolic links to
+        directories are not followed.
+
+        If the IncrementalScan scan is given, the directories it reports as
+        unchanged are not listed, only their subdirectories are walked.
+
+        If after is given, the files up to the walk_position after are
+        skipped, and the directories before it are not entered.
+    """
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        behind = False  # whether the files of path may be before after
+        if after is not None:
+            key = walk_position(root, path)
+            if after[:len(key)] == key:
+                behind = True
+            elif key < after:
+                continue
+            else:
+                # everything left on the stack comes after it.
+                after = None
+        if scan is not None:
+            # stat before listing, so changes made while listing are noticed
+            # by the next scan.
+            try:
+                dst = os.stat(path)
+            except OSError as e:
+                sys.stderr.write(unicode(e))
+                sys.stderr.write("\n")
+                continue
+            dirs = scan.unchanged(path, dst)
+            if dirs is not None:
+                dirs = [d for d in dirs if prune is None or prune.search(d) is None]
+                dirs.reverse()
+                stack.extend(dirs)
+                continue
+        try:
+            entries = list_directory(path)
+        except OSError as e:
+            sys.stderr.write(unicode(e))
+            sys.stderr.write("\n")
+            continue
+        dirs = []
+        newest = None   # the newest mtime of the small files
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    if prune is None or prune.search(entry.path) is None:
+                        dirs.append(entry.path)
+                continue
+            if ignore is not None and ignore.search(entry.path):
+                continue
+            try:
+                st = entry.stat()
+            except OSError as e:
+                # ie, a dead link.
+                sys.stderr.write(unicode(e))
+                sys.stderr.write("\n")
+                continue
+            if st.st_size > minsize:
+                if behind and key + [(0, entry.name)] <= after:
+                    continue
+                yield entry.path, st
+            elif newest is None or st.st_mtime > newest:
+                newest = st.st_mtime
+        if scan is not None:
+            scan.listed(path, dst, dirs, newest)
+        dirs.reverse()
+        stack.extend(dirs)
+
+
+class IncrementalScan:
+    """ Keeps track of the directories walked by a scan, so that directories
+        whose mtime has not changed since they were last listed are not
+        listed again.
+
+        Adding, removing or renaming a file or directory changes the mtime of
+        the directory holding it, but a file growing does not. So a directory
+        is only recorded if its mtime and the mtimes of its small files have
+        settled, none of its files failed to be checked and all of its
+        subdirectories are recorded.
+
+        If full is set, every directory is listed.
+
+        With more than one datafile loaded, a directory is unchanged if it
+        is unchanged in every datafile scanning it, and it is recorded in
+        each of them.
+    """
+    def __init__(self, full=False):
+        self.full = full
+        self.start = time.time()
+        self.skipped = 0
+        # mapping of listed directories to (mtime, subdirectories, newest
+        # mtime of its small files).
+        self.directories = dict()
+
+    def unchanged(self, directory, st):
+        """ Returns the recorded subdirectories of directory if its mtime
+            (from the stat result st) is unchanged, otherwise None.
+        """
+        if self.full:
+            return None
+        dirs = set()
+        for d in covering(directory, True):
+            if d.directory_mtime(directory) != int(st.st_mtime):
+                return None
+            dirs.update(d.subdirectories(directory))
+        self.skipped += 1
+        return sorted(dirs)
+
+    def listed(self, directory, st, dirs, newest):
+        """ Notes that directory (with the stat result st) was listed, with
+            the subdirectories dirs and newest as the newest mtime of the
+            files that are too small to be checked.
+        """
+        self.directories[directory] = (int(st.st_mtime), list(dirs), newest)
+
+    def record(self, failed=()):
+        """ Records the mtimes of the listed directories in the datafile.
+
+            failed is a collection of the files that could not be checked.
+            Returns the set of the datafiles a changed mtime was recorded in.
+        """
+        changed = set()
+        failed = set(os.path.dirname(f) for f in failed)
+        # the mtime of a directory changed in the second it was listed in
+        # could change again without its mtime changing.
+        settled = int(self.start) - 1
+        # reverse order, so subdirectories are recorded before their parent.
+        for directory in sorted(self.directories, reverse=True):
+            mtime, dirs, newest = self.directories[directory]
+            if mtime >= settled or directory in failed:
+                continue
+            if newest is not None and newest >= self.start - DIRECTORY_SETTLE:
+                continue
+            for d in covering(directory, True):
+                if any(d.directory_mtime(s) is None
+                       for s in dirs if d in covering(s, True)):
+                    continue
+                if d.directory_mtime(directory) != mtime:
+                    d.set_directory_mtime(directory, mtime)
+                    changed.add(d)
+        return changed
+
+
+class Checkpoint:
+    """ Records how far the scan of each scan directory has been checked,
+        so an interrupted scan can be resumed where it stopped.
+
+        As walk lists the files in a sorted order and check_files checks
+        them in that order, every file up to the last one checked has been
+        checked. The last file checked is recorded every CHECKPOINT_TIME
+        seconds, and a scan directory is recorded itself once its scan has
+        finished.
+
+        If resume is set, the scan continues from the checkpoint of the
+        first scan directory whose scan has not finished, skipping the scan
+        directories before it. If the scans of all of them have finished, a
+        new scan is started.
+
+        If deadline is given, no more files are listed after that time. An
+        interrupted or killed scan records its checkpoint as a stopped one.
+    """
+    def __init__(self, roots, resume=False, deadline=None):
+        self.roots = roots
+        self.deadline = deadline
+        self.stopped = False
+        self.finished = set()   # scan directories that are skipped
+        self.after = dict()     # scan directory -> walk_position to resume after
+        self.index = 0          # index of the scan directory being checked
+        self.last = None        # the last file checked
+        self.written = time.time()
+        if resume:
+            for root in roots:
+                path = self.recorded(root)
+                if path != root:
+                    if path is not None:
+                        self.after[root] = walk_position(root, path, False)
+                    break
+                self.finished.add(root)
+            else:
+                self.finished.clear()
+
+    def owners(self, root):
+        """ Returns the loaded datafiles that have root as a scan directory."""
+        return [d for d in datafiles if d.is_scan_root(root)]
+
+    def recorded(self, root):
+        """ Returns the checkpoint of root recorded in its datafiles."""
+        for d in self.owners(root):
+            path = d.checkpoint(root)
+            if path is not None:
+                return path
+        return None
+
+    def _write(self, root, path):
+        # only the checkpoints that changed are written, so a scan of
+        # finished scan directories writes no records.
+        for d in self.owners(root):
+            if d.checkpoint(root) != path:
+                d.set_checkpoint(root, path)
+
+    def _finish(self, index):
+        # Records the scans of the scan directories before index as finished.
+        while self.index < index:
+            self._write(self.roots[self.index], self.roots[self.index])
+            self.index += 1
+        self.last = None
+
+    def limit(self, files):
+        """ Generator that passes on the items of files until the deadline."""
+        for item in files:
+            if self.deadline is not None and time.time() >= self.deadline:
+                self.stopped = True
+                return
+            yield item
+
+    def done(self, filename):
+        """ Notes that filename has been checked, see check_files."""
+        # the deepest scan directory holding the file is the one walked.
+        filename = os.path.abspath(filename)
+        root = max((r for r in self.roots if in_directory(filename, r)), key=len)
+        index = self.roots.index(root)
+        if index != self.index:
+            self._finish(index)
+        self.last = filename
+        if time.time() - self.written >= CHECKPOINT_TIME:
+            self.write()
+
+    def write(self):
+        """ Records the last file checked."""
+        if self.last is not None:
+            self._write(self.roots[self.index], self.last)
+        self.written = time.time()
+
+    def close(self):
+        """ Records the last file checked, and if the scan was not stopped
+            the scans of all of the scan directories as finished.
+        """
+        if self.stopped:
+            self.write()
+        else:
+            self._finish(len(self.roots))
+
+
 def concat_parent_directories(filename, r, c=' - '):
     """ Concatinates r parent directories of the given filename into the
         basename of filename.
@@ -359,23 +1793,35 @@ def concat_parent_directories(filename, r, c=' - '):
     return string.join(l, c)
 
 
-def new_file(filename, h=None, t=None):
+def new_file(filename, h=None, t=None, st=None):
     """ Processes a new file.
+
+        st is the optional stat result of the file, see
+        Datafile.append_filehash.
     """
     if h is None:
         h = Hash.FromFile(filename)
     if t is None:
         t = time.localtime()
     
-    datafile.append_filehash(filename, h, t)
+    start = time.time()
+    datafile.append_filehash(filename, h, t, st)
+    profile.timed('write', start)
     if h.size > datafile.config['minsize']:
-        # ::CHECK if the format can be moved to the config directory::
-        for format in ['month/%Y-%m', 'week/%Y-%U', 'day/%Y-%m-%d']:
+        for format in datafile.buckets:
+            if datafile.lazy and is_expired(format, bucket_name(format, t)):
+                # left to --reconcile, should the retention allow it later
+                continue
+            start = time.time()
             linkname = create_link(filename, format, t)
+            profile.timed('link', start)
+            profile.count('links')
+            start = time.time()
             datafile.add_link(h, linkname) 
+            profile.timed('write', start)
 
 
-def renamed_file(newfilename, h=None):
+def renamed_file(newfilename, h=None, st=None):
     """ Removes the old links, and creates the new ones.
 
         Called when a the system has detected a file woth a specific hash has
@@ -391,12 +1837,15 @@ def renamed_file(newfilename, h=None):
     else:  
         t = datafile.get_time(h)
         # Remove the old links.
+        start = time.time()
         for link in datafile.get_links(h):
-            if os.path.lexists(link):
+            if os.path.lexists(link) and not plan('remove', link):
                 os.remove(link)
+            link_names.remove(link)
+        profile.timed('link', start)
         # get the time of the origional link, otherwise
         # it may end up as today
-        new_file(newfilename, h, t)
+        new_file(newfilename, h, t, st)
     
 
 def create_recent_directories(name, format, tdiff):
@@ -407,6 +1856,8 @@ def create_recent_directories(name, format, tdiff):
     target = create_directory(format, t)
     d = os.path.join(datafile.config['target'], name)
 
+    if plan('shortcut', d, target):
+        return
     if os.path.lexists(d):
         if os.path.realpath(d) is not d:
             os.remove(d)
@@ -421,13 +1872,9 @@ def create_recent_directories(name, format, tdiff):
             create_recent_directories(name, format, tdiff)
 
 
-def create_directory(format, t):
-    """ Creates a directory within the recent additions folder for format and
-        time t.
-
-        If the directory already exists then nothing happens.
-
-        This method will return the name of the directory created.
+def bucket_name(format, t):
+    """ Returns the name of the directory for format and time t, relative to
+        the recent additions folder.
     """
     dir = time.strftime(format, t)
 
@@ -436,13 +1883,125 @@ def create_directory(format, t):
     if format.endswith('%U') and dir.endswith('00'):
         lastweek = datetime.date(t.tm_year - 1, 12, 31)
         dir = lastweek.strftime(format)
+    return dir
+
+
+def oldest_bucket(format):
+    """ Returns the name of the oldest bucket directory of format that is
+        within its retention, or None if the buckets are kept forever.
+    """
+    days = datafile.retention.get(os.path.dirname(format))
+    if days is None:
+        return None
+    return bucket_name(format, time.localtime(time.time() - days * 24*60*60))
+
+
+def is_expired(format, name):
+    """ Returns true if the bucket directory name of format is older than
+        its retention.
+    """
+    oldest = oldest_bucket(format)
+    return oldest is not None and name < oldest
+
 
-    dir = os.path.join(datafile.config['target'], dir)
-    # create directory (if necessary)    
-    if os.path.isdir(dir) is False:
-        os.mkdir(dir)
+def is_expired_directory(dir):
+    """ Returns true if the directory dir of the recent additions folder is
+        a bucket directory older than its retention.
+    """
+    name = os.path.relpath(dir, datafile.config['target'])
+    for format in datafile.buckets:
+        if os.path.dirname(format) == os.path.dirname(name):
+            return is_expired(format, name)
+    return False
+
+
+def create_directory(format, t):
+    """ Creates a directory within the recent additions folder for format and
+        time t.
+
+        If the directory already exists then nothing happens.
+
+        This method will return the name of the directory created.
+    """
+    dir = os.path.join(datafile.config['target'], bucket_name(format, t))
+    # create directory (if necessary, once per run)
+    if not link_names.has_directory(dir):
+        if os.path.isdir(dir) is False and not plan('mkdir', dir):
+            os.makedirs(dir)
+        link_names.add_directory(dir)
     return dir
 
+
+class LinkNames:
+    """ An index of the names in the directories of the recent additions
+        folder, so links are named and collisions resolved without probing
+        the filesystem for every link.
+
+        A directory is listed the first time it is looked into, and the
+        target of an existing link is read the first time it is needed.
+        The index is kept up to date with the links made, renamed and removed
+        by the run, but not with changes made by anything else.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """ Forgets the directories and names in the index."""
+        self.created = set()
+        self.directories = dict()   # directory -> dict of names to targets (None if not read)
+
+    def has_directory(self, dir):
+        """ Returns true if the directory was created or found to exist."""
+        return dir in self.created
+
+    def add_directory(self, dir):
+        """ Notes that the directory exists."""
+        self.created.add(dir)
+
+    def _names(self, dir):
+        names = self.directories.get(dir)
+        if names is None:
+            try:
+                names = dict.fromkeys(os.listdir(dir))
+            except OSError:
+                # ie, a directory not made by a dry run
+                names = dict()
+            self.directories[dir] = names
+        return names
+
+    def exists(self, link):
+        """ Returns true if there is an entry named link."""
+        dir, name = os.path.split(link)
+        return name in self._names(dir)
+
+    def target(self, link):
+        """ Returns the target of the existing link."""
+        dir, name = os.path.split(link)
+        names = self._names(dir)
+        if names[name] is None:
+            names[name] = os.readlink(link)
+        return names[name]
+
+    def add(self, link, filename):
+        """ Notes a link to filename was made."""
+        dir, name = os.path.split(link)
+        self._names(dir)[name] = filename
+
+    def remove(self, link):
+        """ Notes the link was removed."""
+        dir, name = os.path.split(link)
+        if dir in self.directories:
+            self.directories[dir].pop(name, None)
+
+    def rename(self, link, newlink):
+        """ Notes the link was renamed to newlink."""
+        filename = self.target(link)
+        self.remove(link)
+        self.add(newlink, filename)
+
+
+link_names = LinkNames()
+
  
 def create_link(filename, format, t):
     """ Creates the link to the filename in a directory with the given format
@@ -462,9 +2021,13 @@ def create_link(filename, format, t):
     link = os.path.join(dir, basename)
 
     # check if there is a collision with the link
-    if os.path.exists(link):
+    if link_names.exists(link):
         # restore the name of the previous link
-        ofilename = os.readlink(link)
+        ofilename = link_names.target(link)
+        if ofilename == filename:
+            # the link was made by a run that ended before its records
+            # were written.
+            return link
         olinkname = link
         linkname = link
         # diverse until there is no collision
@@ -479,73 +2042,835 @@ def create_link(filename, format, t):
         # save r value
         datafile.set_linkname_collision(link, r)
         # rename old link
-        os.rename(link, olinkname)
+        if not plan('rename', link, olinkname):
+            os.rename(link, olinkname)
+        link_names.rename(link, olinkname)
         link = linkname
     # make link
-    os.symlink(filename, link)
+    if not plan('link', link, filename):
+        os.symlink(filename, link)
+    link_names.add(link, filename)
     return link
 
 
-def check_file(filename, t=None):
+# where a dry run writes the actions that would have been taken (stderr when
+# stdout holds the --json report).
+plan_output = sys.stdout
+
+
+def plan(action, *paths):
+    """ Returns True if the run is a dry run, in which case the action that
+        would have been taken is written to plan_output instead.
+    """
+    if not datafile.dry_run:
+        return False
+    plan_output.write("%s %s\n" % (action, ' -> '.join(paths)))
+    return True
+
+
+def reconcile():
+    """ Reconciles the bucket directories of the target directory with the
+        links recorded in the datafile, in a single pass over the target.
+
+        Links to files that no longer exist and links to files that are not
+        in the datafile are removed, and recorded links of existing files
+        that are missing are recreated. Bucket directories older than their
+        retention are emptied of links and removed, and with 'retained'
+        materialization the links new_file left out of the buckets still
+        within their retention are created.
+
+        Returns a dict of the number of links and directories affected.
+    """
+    counts = dict(dead=0, orphaned=0, expired=0, recreated=0, pruned=0,
+                  materialized=0)
+    target = datafile.config['target']
+    # (bucket directory, file) -> recorded link
+    expected = dict(((os.path.dirname(link), filename), link)
+                    for link, filename in datafile.live_links().iteritems())
+    files = set(filename for d, filename in expected)
+
+    for format in datafile.buckets:
+        top = os.path.dirname(format)
+        oldest = oldest_bucket(format)
+        try:
+            names = sorted(os.listdir(os.path.join(target, top)))
+        except OSError:
+            continue
+        for name in names:
+            dir = os.path.join(target, top, name)
+            if not os.path.isdir(dir) or os.path.islink(dir):
+                continue
+            expired = oldest is not None and os.path.join(top, name) < oldest
+            for entry in list_directory(dir):
+                if not entry.is_symlink():
+                    continue
+                filename = os.readlink(entry.path)
+                if expired:
+                    counts['expired'] += 1
+                elif not os.path.exists(entry.path):
+                    counts['dead'] += 1
+                elif filename in files:
+                    # a recorded link, or one renamed by a collision
+                    expected.pop((dir, filename), None)
+                    continue
+                else:
+                    counts['orphaned'] += 1
+                os.remove(entry.path)
+            if expired:
+                try:
+                    os.rmdir(dir)
+                    counts['pruned'] += 1
+                except OSError:
+                    # something other than links is in the directory
+                    pass
+
+    for (dir, filename), link in sorted(expected.iteritems()):
+        if os.path.lexists(link) or not os.path.exists(filename):
+            continue
+        if is_expired_directory(dir):
+            # the bucket has been pruned, by this or an earlier run
+            continue
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        os.symlink(filename, link)
+        counts['recreated'] += 1
+
+    if datafile.lazy:
+        counts['materialized'] = materialize()
+    return counts
+
+
+def materialize():
+    """ Links the recorded files into the bucket directories that are
+        within their retention and have no link of the file's hash.
+
+        Returns the number of links created.
+    """
+    count = 0
+    for filename, h in sorted(datafile.file_hashes().iteritems()):
+        if h.size <= datafile.config['minsize']:
+            continue
+        t = datafile.get_time(h)
+        linked = set(os.path.dirname(link) for link in datafile.get_links(h))
+        formats = list()
+        for format in datafile.buckets:
+            name = bucket_name(format, t)
+            if is_expired(format, name):
+                continue
+            if os.path.join(datafile.config['target'], name) in linked:
+                continue
+            formats.append(format)
+        # only the files with a link to make are looked up on the disk
+        if not formats or not os.path.exists(filename):
+            continue
+        for format in formats:
+            datafile.add_link(h, create_link(filename, format, t))
+            count += 1
+    return count
+
+
+def duplicates(verify=False, workers=1):
+    """ Returns the groups of existing files with the same hash in the
+        loaded datafiles, as a list of (hash, filenames) tuples sorted by the number
+        of bytes that could be reclaimed.
+
+        Files that are hard links of each other are only counted once, and
+        files whose size is no longer the size of their hash are left out.
+        If verify is set, the files of each group are compared in full and
+        the group is split into the files that are really identical.
+    """
+    files = dict()
+    for d in datafiles or [datafile]:
+        files.update(d.file_hashes())
+    groups = dict()
+    for filename, h in files.iteritems():
+        groups.setdefault(str(h), (h, list()))[1].append(filename)
+
+    pool = None
+    if verify:
+        pool = ThreadPool(max(workers, 1))
+    found = list()
+    try:
+        for key, (h, filenames) in groups.iteritems():
+            if len(filenames) < 2:
+                continue
+            inodes = dict()     # (device, inode) -> filename
+            for filename in sorted(filenames):
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                if st.st_size == h.size:
+                    inodes.setdefault((st.st_dev, st.st_ino), filename)
+            if len(inodes) < 2:
+                continue
+            files = sorted(inodes.itervalues())
+            if verify:
+                for same in identical_files(files, pool):
+                    found.append((h, same))
+            else:
+                found.append((h, files))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    found.sort(key=lambda group: (-reclaimable(*group), group[1]))
+    return found
+
+
+def reclaimable(h, files):
+    """ Returns the number of bytes reclaimed by removing all but one of the
+        duplicate files.
+    """
+    return h.size * (len(files) - 1)
+
+
+def identical_files(files, pool, bufsize=HASHBUF):
+    """ Returns the lists of files with the same contents among files, of
+        at least two files each.
+
+        The files are read a block at a time, each block of the files being
+        read in parallel by the pool, and files stop being read as soon as
+        they differ from all of the other files.
+    """
+    def read_block(fp):
+        return fp.read(bufsize)
+
+    fps = dict()
+    try:
+        for filename in files:
+            try:
+                fps[filename] = open(filename, 'rb')
+            except IOError as e:
+                sys.stderr.write(unicode(e))
+                sys.stderr.write("\n")
+        groups = [sorted(fps)]
+        identical = list()
+        while groups:
+            group = groups.pop()
+            if len(group) < 2:
+                continue
+            blocks = pool.map(read_block, [fps[f] for f in group])
+            if not any(blocks):
+                # all at EOF
+                identical.append(group)
+                continue
+            same = collections.OrderedDict()
+            for filename, block in zip(group, blocks):
+                same.setdefault(block, list()).append(filename)
+            groups.extend(same.itervalues())
+    finally:
+        for fp in fps.itervalues():
+            fp.close()
+    identical.sort()
+    return identical
+
+
+def write_duplicates(found, as_json=False, fp=sys.stdout):
+    """ Writes the duplicate groups found by duplicates to fp, either as CSV
+        (one line per file) or as JSON.
+    """
+    total = sum(reclaimable(h, files) for h, files in found)
+    if as_json:
+        groups = [dict(hash=str(h), size=h.size, files=files,
+                       reclaimable=reclaimable(h, files)) for h, files in found]
+        json.dump(dict(groups=groups, reclaimable=total), fp, indent=2, sort_keys=True)
+        fp.write("\n")
+    else:
+        writer = csv.writer(fp)
+        writer.writerow(['group', 'hash', 'size', 'reclaimable', 'filename'])
+        for i, (h, files) in enumerate(found):
+            for filename in files:
+                writer.writerow([i, str(h), h.size, reclaimable(h, files), filename])
+    sys.stderr.write("%d groups of duplicates, %d bytes reclaimable\n" % (len(found), total))
+
+
+# the loaded datafiles, the functions of the program work on the one in
+# datafile.
+datafiles = []
+
+
+def in_directory(path, directory):
+    """ Returns true if the path is the directory or is in it."""
+    return path == directory or path.startswith(directory.rstrip('/') + '/')
+
+
+def use_datafile(d):
+    """ Makes d the datafile the functions of the program work on."""
+    global datafile
+    datafile = d
+
+
+def covering(path, isdir=False):
+    """ Returns the list of the loaded datafiles that scan the path, see
+        Datafile.is_scanned.
+    """
+    if len(datafiles) <= 1:
+        return [datafile]
+    return [d for d in datafiles if d.is_scanned(path, isdir)]
+
+
+def scan_roots():
+    """ Returns the sorted (absolute) scan directories of the loaded
+        datafiles.
+    """
+    if len(datafiles) <= 1:
+        return datafile.scan_roots
+    return sorted(set(r for d in datafiles for r in d.scan_roots))
+
+
+class PathMatcher:
+    """ Wraps a function of a path, so it can be used as the prune or ignore
+        regex of walk.
+    """
+    def __init__(self, match):
+        self.match = match
+
+    def search(self, path):
+        """ Returns True if the function matches the path, otherwise None."""
+        if self.match(path):
+            return True
+        return None
+
+
+def candidate_datafiles(filename, st=None):
+    """ Returns the list of (datafile, filename) tuples of the loaded
+        datafiles the file is a candidate file of, see candidate_file.
+
+        With more than one datafile loaded, the file must also be in the
+        scan directories of the datafile and larger than its minsize (given
+        the stat result st).
+    """
+    if len(datafiles) <= 1:
+        filename = candidate_file(filename)
+        if filename is None:
+            return []
+        return [(datafile, filename)]
+    filename = os.path.abspath(filename)
+    found = list()
+    for d in covering(filename):
+        if st is not None and st.st_size <= d.config['minsize']:
+            continue
+        if not d.in_ignorelist(filename) and d.filename_is_unique(filename):
+            found.append((d, filename))
+    if not found:
+        profile.count('skipped')
+    return found
+
+
+def recorded_hash(targets, st):
+    """ Returns the hash recorded for the stat result st by any of the
+        datafiles of targets, or None.
+    """
+    for d, filename in targets:
+        h = d.stat_hash(st)
+        if h is not None:
+            return h
+    return None
+
+
+def process_targets(targets, h, t, st=None):
+    """ Files a hashed candidate file in each of the (datafile, filename)
+        tuples of targets, see process_file.
+    """
+    current = datafile
+    try:
+        for d, filename in targets:
+            use_datafile(d)
+            process_file(filename, h, t, st)
+    finally:
+        use_datafile(current)
+
+
+def candidate_file(filename):
+    """ Returns the absolute filename if the given file is not ignored and is
+        not already in the datafile, otherwise None is returned.
+    """
+    if datafile.in_ignorelist(filename):
+        profile.count('skipped')
+        return None
+    # This helps prevent dead links
+    filename = os.path.abspath(filename)
+    if datafile.filename_is_unique(filename):
+        return filename
+    profile.count('skipped')
+    return None
+
+
+def process_file(filename, h, t, st=None):
+    """ Files a hashed candidate file as either a renamed or a new file."""
+    if datafile.hash_exists(h):
+        # The file has been moved or renamed.
+        profile.count('renamed')
+        plan('renamed', filename)
+        renamed_file(filename, h, st)
+    else:
+        profile.count('new')
+        plan('new', filename)
+        new_file(filename, h, t, st)
+
+
+def check_file(filename, t=None, st=None):
     """ Checks if the given file is unique and if so then create the links to
         the filename in the 'recent additions' month, day and week
         directories.
 
         t is a time struct containing the time in which the file was created.
         If None (or ommitted) then the current localtime will be used.
+
+        st is the stat result of the file, if None it will be read.
+
+        Returns False if the file could not be read, otherwise True.
     """
-    if not datafile.in_ignorelist(filename):
+    targets = candidate_datafiles(filename, st)
+    if targets:
+        filename = targets[0][1]
         if t is None:
             t = time.localtime()
-        # This helps prevent dead links
-        filename = os.path.abspath(filename)
-    
-        if datafile.filename_is_unique(filename):
-            # The file may be new, check its hash
-            try:
+        try:
+            # A file moved within a filesystem keeps its inode and mtime.
+            if st is None:
+                st = os.stat(filename)
+            h = recorded_hash(targets, st)
+            if h is None:
+                # The file may be new, check its hash
                 h = Hash.FromFile(filename)
-                if datafile.hash_exists(h):
-                    # The file has been moved or renamed.
-                    renamed_file(filename, h)
-                else:
-                    new_file(filename, h, t)
-            except IOError as e:
-                sys.stderr.write(unicode(e))
-                sys.stderr.write("\n")
+            else:
+                profile.count('stat_matched')
+            process_targets(targets, h, t, st)
+        except (IOError, OSError) as e:
+            sys.stderr.write(unicode(e))
+            sys.stderr.write("\n")
+            return False
+    return True
+
+
+def check_files(files, workers=1, failed=None, done=None):
+    """ Checks each (filename, t, st) tuple in files, see check_file.
+
+        If workers is greater than one, the candidate files are hashed by a
+        pool of worker threads. The results are processed by the calling
+        thread in the order of files, so the datafile and the links are
+        written exactly as they would be by a single thread.
+
+        If the set failed is given, the files that could not be read are
+        added to it. If the function done is given, it is called with the
+        filename of each file checked, in the order of files.
+
+        Each file is hashed once, and filed in every loaded datafile it is a
+        candidate file of.
+    """
+    if failed is None:
+        failed = set()
+    if workers <= 1:
+        for filename, t, st in files:
+            if not check_file(filename, t, st):
+                failed.add(filename)
+            if done is not None:
+                done(filename)
+        return
+
+    def process(pending):
+        filename, t, st, h, targets = pending
+        try:
+            if not isinstance(h, Hash):
+                h = h.get()
+            # the filename may have been queued twice (overlapping scans)
+            process_targets([(d, f) for d, f in targets if d.filename_is_unique(f)], h, t, st)
+        except (IOError, OSError) as e:
+            sys.stderr.write(unicode(e))
+            sys.stderr.write("\n")
+            failed.add(filename)
+        if done is not None:
+            done(filename)
+
+    pool = ThreadPool(workers)
+    queue = collections.deque()
+    try:
+        for filename, t, st in files:
+            targets = candidate_datafiles(filename, st)
+            if not targets:
+                continue
+            filename = targets[0][1]
+            if t is None:
+                t = time.localtime()
+            if st is None:
+                try:
+                    st = os.stat(filename)
+                except OSError as e:
+                    sys.stderr.write(unicode(e))
+                    sys.stderr.write("\n")
+                    failed.add(filename)
+                    continue
+            h = recorded_hash(targets, st)
+            if h is None:
+                h = pool.apply_async(Hash.FromFile, (filename,))
+            else:
+                profile.count('stat_matched')
+            queue.append((filename, t, st, h, targets))
+            if len(queue) >= workers * QUEUE_FACTOR:
+                process(queue.popleft())
+        while queue:
+            process(queue.popleft())
+    finally:
+        pool.close()
+        pool.join()
+
+
+def scan_files(file_time=False, counts=None, scan=None, checkpoint=None):
+    """ Generator that lists the (filename, t, st) tuples of the files in the
+        scan directories that are not pruned, ignored or too small.
+
+        If file_time is set, t is the mtime of the file, otherwise it is None.
+        If the dict counts is given, its 'files' entry is incremented for
+        every file listed. If the IncrementalScan scan is given, unchanged
+        directories are not listed. If the Checkpoint checkpoint is given,
+        the files it has been checked past are skipped.
+
+        A scan directory within another one is only walked from itself. With
+        more than one datafile loaded, the scan directories of all of the
+        datafiles are walked once, listing the files of any datafile.
+    """
+    roots = scan_roots()
+    prune = datafile.prune_regex
+    ignore = datafile.ignore_regex
+    minsize = datafile.config['minsize']
+    nested = set(os.path.normpath(r) for r in roots
+                 if any(r != o and in_directory(r, o) for o in roots))
+    if nested and len(datafiles) <= 1:
+        regex = prune
+        prune = PathMatcher(lambda path: os.path.normpath(path) in nested or
+                (regex is not None and regex.search(path) is not None))
+    if len(datafiles) > 1:
+        prune = PathMatcher(lambda path: path in roots or not covering(path, True))
+        ignore = PathMatcher(lambda path: all(d.in_ignorelist(path) for d in datafiles))
+        minsize = min(d.config['minsize'] for d in datafiles)
+    for d in roots:
+        after = None
+        if checkpoint is not None:
+            if d in checkpoint.finished:
+                continue
+            after = checkpoint.after.get(d)
+        for f, st in walk(d, prune, ignore, minsize, scan, after):
+            if counts is not None:
+                counts['files'] = counts.get('files', 0) + 1
+            if file_time:
+                yield f, time.localtime(st.st_mtime), st
+            else:
+                yield f, None, st
+
+
+def file_times(filenames, file_time=False):
+    """ Generator that turns filenames into the (filename, t, st) tuples of
+        check_files, skipping files that no longer exist or are too small.
+
+        If file_time is set, t is the mtime of the file, otherwise it is None.
+    """
+    for f in filenames:
+        try:
+            st = os.stat(f)
+        except OSError:
+            continue
+        if st.st_size <= datafile.config['minsize']:
+            continue
+        if file_time:
+            yield f, time.localtime(st.st_mtime), st
+        else:
+            yield f, None, st
+
+
+def create_shortcuts():
+    """ Creates the relative shortcuts in the target directory."""
+    for name, format, days in datafile.shortcuts:
+        create_recent_directories(name, format, days * 24*60*60)
+
+
+def watch(workers=1, file_time=False, settle=WATCH_SETTLE):
+    """ Watches the scan directories with inotify and checks the files that
+        are written, created or moved into them. Never returns.
+
+        A file is checked once there have been no events for it for settle
+        seconds, so files still being written are not hashed early. The scan
+        directories are scanned fully once the watches are in place, and
+        again if the kernel event queue overflows.
+
+        Files that are deleted are not watched for. As with a scan, their
+        links are left until they are removed by --reconcile.
+    """
+    pending = dict()    # filename -> time of its last event
+    rescan = [True]
+
+    class Handler(pyinotify.ProcessEvent):
+        def process_default(self, event):
+            # walk only prunes the directories below the one it is given.
+            if not datafile.is_scanned(os.path.abspath(event.pathname), event.dir):
+                return
+            if event.dir:
+                # files may have been added before the directory was watched
+                for f, st in walk(event.pathname, datafile.prune_regex, datafile.ignore_regex):
+                    pending[f] = time.time()
+            else:
+                pending[event.pathname] = time.time()
+
+        def process_IN_MODIFY(self, event):
+            if event.pathname in pending:
+                pending[event.pathname] = time.time()
+
+        def process_IN_Q_OVERFLOW(self, event):
+            rescan[0] = True
+
+    mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+            pyinotify.IN_CREATE | pyinotify.IN_MODIFY)
+    wm = pyinotify.WatchManager()
+    notifier = pyinotify.Notifier(wm, Handler(), timeout=settle * 1000)
+    def pruned(path):
+        return datafile.prune_regex is not None and datafile.prune_regex.search(path) is not None
+
+    for d in sorted(datafile.config['scan']):
+        wm.add_watch(d, mask, rec=True, auto_add=True, exclude_filter=pruned)
+
+    today = None
+    while True:
+        if rescan[0]:
+            rescan[0] = False
+            pending.clear()
+            check_files(scan_files(file_time), workers)
+        if notifier.check_events():
+            notifier.read_events()
+            notifier.process_events()
+
+        now = time.time()
+        ready = sorted(f for f, t in pending.iteritems() if now - t >= settle)
+        for f in ready:
+            del pending[f]
+        check_files(file_times(ready, file_time), workers)
+        datafile.flush()
+
+        if today != time.localtime().tm_yday:
+            today = time.localtime().tm_yday
+            # the links of the days before are no longer made
+            link_names.clear()
+            create_shortcuts()
 
 
 def main():
     """ Main function call for the program.
 
-        Loads the datafile and checks for any changes in the sources folders.
+        Loads the datafiles and checks for any changes in the sources folders.
     """
     parser = argparse.ArgumentParser(description='Recent Additions Directory updator.')
-    parser.add_argument('datafile', nargs=1,
-            help='The datafile of the Recent Additions Directory.')
+    parser.add_argument('datafile', nargs='+',
+            help="""The datafile of the Recent Additions Directory. If more than one datafile is given, their scan
+directories are walked and their files hashed once for all of them.""")
     parser.add_argument('-f', '--file-time', dest='file_time', action='store_true', default=False, 
             help="""Uses the files mtime as the creation time of any new files found in the source directories.
 (if not selected then the current time will be used for any new files found.)""")
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=None,
+            help='The number of threads used to hash new files (overrides the workers parameter).')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', default=False,
+            help='Reports the scanning speed on stderr.')
+    parser.add_argument('--stats', dest='stats', action='store_true', default=False,
+            help='Reports the size of the datafile index and the peak memory use on stderr.')
+    parser.add_argument('--profile', dest='profile', action='store_true', default=False,
+            help="""Reports the time spent loading the datafile, walking, hashing, linking and writing records,
+the number of files handled and the hashing throughput on stderr.""")
+    parser.add_argument('--json', dest='json', action='store_true', default=False,
+            help="""Writes the --profile and --stats reports (or the --duplicates) as a JSON object on stdout instead.
+The actions of a --dry-run are then written to stderr.""")
+    parser.add_argument('-n', '--dry-run', dest='dry_run', action='store_true', default=False,
+            help="""Writes the links that would be made or changed to stdout, without changing the datafile or the
+recent additions directory.""")
+    parser.add_argument('--full-scan', dest='full_scan', action='store_true', default=False,
+            help='Lists every scanned directory, even the directories that have not changed since the last scan.')
+    parser.add_argument('--reconcile', dest='reconcile', action='store_true', default=False,
+            help="""Removes dead and orphaned links, recreates missing links and removes expired bucket directories
+in the recent additions directory, then exits.""")
+    parser.add_argument('--duplicates', dest='duplicates', action='store_true', default=False,
+            help="""Writes the groups of recorded files with the same hash as CSV (or JSON with --json) on stdout,
+then exits.""")
+    parser.add_argument('--verify', dest='verify', action='store_true', default=False,
+            help='Compares the contents of the --duplicates in full, using the --jobs threads.')
+    parser.add_argument('--compact', dest='compact', action='store_true', default=False,
+            help='Rewrites the datafile keeping only the live records, then exits.')
+    parser.add_argument('-w', '--watch', dest='watch', action='store_true', default=False,
+            help="""Keeps running after the initial scan, checking files as they are added to the source directories.
+The links of deleted files are left for --reconcile. (requires pyinotify)""")
+    parser.add_argument('--settle', dest='settle', type=int, default=WATCH_SETTLE,
+            help='The number of seconds a watched file must be unchanged before it is checked (default %(default)s).')
+    parser.add_argument('--resume', dest='resume', action='store_true', default=False,
+            help='Continues an interrupted or stopped scan from its last checkpoint.')
+    parser.add_argument('--max-seconds', dest='max_seconds', type=int, default=None,
+            help='Stops listing files after this many seconds, so the scan can be continued with --resume.')
     
     options = parser.parse_args()
-
-    global datafile
-    datafile = Datafile.Load(options.datafile[0])
-
-    Hash.set_shaclip(datafile.config['shaclip'])
+    if options.watch and pyinotify is None:
+        parser.error("--watch requires the pyinotify module")
+    if options.dry_run and (options.watch or options.compact or options.reconcile):
+        parser.error("--dry-run can not be used with --watch, --compact or --reconcile")
+    if options.verify and not options.duplicates:
+        parser.error("--verify can only be used with --duplicates")
+    if options.json and not (options.profile or options.stats or options.duplicates):
+        parser.error("--json can only be used with --profile, --stats or --duplicates")
+    if options.watch and len(options.datafile) > 1:
+        parser.error("--watch can only be used with a single datafile")
+
+    if options.json:
+        global plan_output
+        plan_output = sys.stderr
+
+    # write the buffered records if the run is killed.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    try:
+        # every datafile stays locked until the run is finished.
+        for name in options.datafile:
+            start = time.time()
+            datafiles.append(Datafile.Load(name, options.dry_run))
+            profile.timed('load', start)
+        use_datafile(datafiles[0])
+        run(options)
+    finally:
+        for d in datafiles:
+            d.close()
+        del datafiles[:]
+        use_datafile(None)
+
+
+def hash_parameters(d):
+    """ Returns the (shaclip, hash, sampling) parameters of the datafile d
+        the hashes of new files depend on.
+    """
+    sampling = None
+    if d.config.get('fingerprint', 'clip') == 'sampled':
+        sampling = (d.config.get('samples', SAMPLING[0]),
+                    d.config.get('samplesize', SAMPLING[1]))
+    return d.config['shaclip'], d.config.get('hash', 'sha1'), sampling
+
+
+def run(options):
+    """ Runs the program with the parsed options on the loaded datafiles."""
+    workers = options.jobs
+    if workers is None:
+        workers = max(d.config.get('workers', 1) for d in datafiles)
+
+    if options.compact:
+        for d in datafiles:
+            removed, records = d.compact()
+            sys.stdout.write("Compacted %s: removed %d records (%d bytes)\n"
+                    % (d.datafilename, records, removed))
+        return
+
+    if options.duplicates:
+        write_duplicates(duplicates(options.verify, workers), options.json)
+        return
+
+    if options.reconcile:
+        for d in datafiles:
+            use_datafile(d)
+            counts = reconcile()
+            sys.stdout.write("Reconciled %s: removed %d dead, %d orphaned and %d expired links, "
+                    "recreated %d and materialized %d links and removed %d directories\n"
+                    % (datafile.config['target'], counts['dead'], counts['orphaned'],
+                       counts['expired'], counts['recreated'], counts['materialized'],
+                       counts['pruned']))
+        return
+
+    # files are hashed once for all of the datafiles.
+    parameters = hash_parameters(datafile)
+    for d in datafiles:
+        if hash_parameters(d) != parameters:
+            raise DataFileError("the shaclip, hash and fingerprint parameters of %s differ from %s"
+                    % (d.datafilename, datafile.datafilename))
+    shaclip, hashname, sampling = parameters
+    Hash.set_shaclip(shaclip)
+    Hash.set_engine(hashname,
+                    datafile.config.get('hashbuf', HASHBUF),
+                    datafile.config.get('hashio', 'readinto') == 'mmap',
+                    sampling)
    
-    for d in datafile.config['scan']:
-        for f in locate(d):
-            if options.file_time:
-                mtime = time.localtime(os.path.getmtime(f))
-                check_file(f, mtime)
-            else:
-                check_file(f)
+    if options.watch:
+        watch(workers, options.file_time, options.settle)
+
+    full = options.full_scan
+    for d in datafiles:
+        fullscan = d.config.get('fullscan', 0)
+        if fullscan > 0 and d.scan_count() + 1 >= fullscan:
+            full = True
+    scan = IncrementalScan(full)
+    deadline = None
+    if options.max_seconds is not None:
+        deadline = scan.start + options.max_seconds
+    checkpoint = Checkpoint(scan_roots(), options.resume, deadline)
+    counts = profile.counts
+    failed = set()
+    files = checkpoint.limit(scan_files(options.file_time, counts, scan, checkpoint))
+    try:
+        check_files(profile.walked(files), workers, failed, checkpoint.done)
+    except (KeyboardInterrupt, SystemExit):
+        # keep how far the scan got (SIGTERM exits), so it can be resumed
+        checkpoint.stopped = True
+        checkpoint.close()
+        raise
+    profile.count('failed', len(failed))
+    start = time.time()
+    checkpoint.close()
+    if not checkpoint.stopped:
+        # the directories of a stopped scan may not have been checked fully.
+        changed = scan.record(failed)
+        for d in datafiles:
+            if scan.full:
+                if d.scan_count() != 0:
+                    d.set_scan_count(0)
+            elif d in changed:
+                d.set_scan_count(d.scan_count() + 1)
+    for d in datafiles:
+        d.flush()
+    profile.timed('write', start)
+    if options.verbose:
+        seconds = max(time.time() - scan.start, 0.001)
+        sys.stderr.write("Scanned %d files in %.1f seconds (%.0f files/sec)\n"
+                % (counts.get('files', 0), seconds, counts.get('files', 0) / seconds))
+        sys.stderr.write("Listed %d directories, skipped %d unchanged directories\n"
+                % (len(scan.directories), scan.skipped))
+        if checkpoint.stopped:
+            sys.stderr.write("Stopped after %d seconds, continue with --resume\n"
+                    % options.max_seconds)
     # Create relative shortcuts.
-    create_recent_directories('Today', 'day/%Y-%m-%d', 0)
-    create_recent_directories('Yesterday', 'day/%Y-%m-%d', 24*60*60)
-    create_recent_directories('This week', 'week/%Y-%U', 0)
-    create_recent_directories('Last week', 'week/%Y-%U', 7*24*60*60)
-    create_recent_directories('This month', 'month/%Y-%m', 0)
+    for d in datafiles:
+        use_datafile(d)
+        create_shortcuts()
+
+    report = dict()
+    if options.profile:
+        report['profile'] = profile.report()
+    if options.stats:
+        if len(datafiles) > 1:
+            report['index'] = dict((d.datafilename, dict(d.index_sizes())) for d in datafiles)
+        else:
+            report['index'] = dict(datafile.index_sizes())
+        report['peak_memory_kb'] = peak_memory()
+    if options.json:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+        return
+
+    if options.profile:
+        p = report['profile']
+        sys.stderr.write("Finished in %.2f seconds\n" % p['seconds'])
+        for phase in Profile.PHASES:
+            sys.stderr.write("%s: %.2f seconds\n" % (phase, p['phases'][phase]))
+        for name in ['files', 'skipped', 'stat_matched', 'hashed', 'new', 'renamed', 'links', 'failed']:
+            sys.stderr.write("%s: %d\n" % (name, p['counts'].get(name, 0)))
+        sys.stderr.write("hashed %.1f MB (%.1f MB/s hashing, %.1f MB/s overall)\n"
+                % (p['counts'].get('bytes_hashed', 0) / (1024.0 * 1024.0),
+                   p['hash_mb_per_sec'], p['mb_per_sec']))
+    if options.stats:
+        for d in datafiles:
+            if len(datafiles) > 1:
+                sys.stderr.write("%s:\n" % d.datafilename)
+            for name, number in d.index_sizes():
+                sys.stderr.write("%s: %d\n" % (name, number))
+        sys.stderr.write("peak memory: %d KB\n" % peak_memory())
+
 
 if __name__ == "__main__":
     main()
@@ -7,14 +7,110 @@ requests and prints them to stdout.
 
 As ngrep requires privlige escalation, this script will execute ngrep with
 sudo. This prevents python from being executed as root.
+
+The packet backend (--backend packet) reads the packets from an AF_PACKET
+socket instead, parsing the TCP payloads itself. The kernel only passes on the
+TCP packets sent to the port, and the packets are read and printed in batches.
+It needs to be run as root (or with CAP_NET_RAW).
+
+The packet backend reassembles the TCP stream of each connection, so requests
+split over several packets and every request of a keep-alive connection are
+found. The memory kept per connection is bounded, and connections that are
+idle for --flow-timeout seconds are forgotten.
+
+A pcap file can be read with --read, which needs no privileges.
+
+The --port and --interface options can be given more than once, all of the
+captures being read by one process. The URLs are then prefixed with the
+interface (or pcap file) and the port they were captured on, ie
+'eth0:8080 http://example.com/'.
+
+With --format json every request is written as a JSON line with its time,
+the client and server addresses, the method, the host and the path. The
+output can be written to a log file with --output, which is compressed if its
+name ends with .gz and rotated every --rotate-size (uncompressed) megabytes.
+The output is written every --flush seconds, rather than after every request.
+The counters are printed to stderr with --stats, and when SIGUSR1 is
+received.
+
+With --aggregate the requests are counted instead of written, and every
+--aggregate seconds a summary of the --top most requested hosts and URLs of
+the last --window seconds is written. Only --max-urls hosts and URLs are
+counted at a time, the least recently requested being forgotten. With --first
+only the first request of each URL (of the last --max-urls) is written, and
+the repeated requests are left to the summaries.
 """
 
 import os
 import re
 import sys
+import time
+import json
+import gzip
+import zlib
+import errno
+import heapq
+import datetime
+import math
+import collections
+import ctypes
+import select
+import signal
+import socket
+import struct
 import argparse
 import subprocess
 
+# the number of bytes of a packet that are captured.
+SNAPLEN = 65535
+
+# the number of packets read from the socket at a time.
+BATCH = 256
+
+# constants of linux/if_ether.h, linux/if_packet.h and asm/socket.h
+ETH_P_ALL = 0x0003
+SOL_PACKET = 263
+PACKET_OUTGOING = 4
+PACKET_STATISTICS = 6
+SO_ATTACH_FILTER = 26
+ARPHRD_LOOPBACK = 772
+
+# the number of bytes of a request (line and headers) that are buffered at
+# most, and the number of bytes of out of order packets kept per connection.
+MAX_REQUEST = 64 * 1024
+MAX_PENDING = 64 * 1024
+
+# the number of connections that are followed at most.
+MAX_FLOWS = 10000
+
+# seconds a connection may be idle before it is forgotten.
+FLOW_TIMEOUT = 60
+
+# the methods of the requests that are reported.
+METHODS = (b'GET', b'HEAD', b'POST')
+
+# the default number of megabytes written to a log file before it is rotated.
+ROTATE_SIZE = 100
+
+# the default number of rotated log files kept.
+ROTATE_COUNT = 5
+
+# the default number of hosts and URLs counted (or remembered with --first).
+MAX_URLS = 10000
+
+# the default number of hosts and URLs in a summary.
+TOP = 10
+
+# TCP flags
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+
+# pcap link types
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+
 def parse_arguments():
     parser = argparse.ArgumentParser(
                         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -26,15 +122,78 @@ def parse_arguments():
                         required=False, default=False,
                         help='Be verbose.')
 
-    parser.add_argument('-p', '--port', type=int,
-                        required=False, default=80,
-                        help='Use a specified port.')
+    parser.add_argument('-p', '--port', type=int, action='append',
+                        required=False, default=None,
+                        help='Use a specified port (default 80). Can be given more than once.')
+
+    parser.add_argument('-i', '--interface', action='append',
+                        required=False, default=None,
+                        help='Interface to capture on (default eth0). Can be given more than once.')
+
+    parser.add_argument('-b', '--backend', choices=['ngrep', 'packet'],
+                        required=False, default='ngrep',
+                        help='Capture with ngrep or from an AF_PACKET socket.')
+
+    parser.add_argument('-r', '--read', action='store',
+                        required=False, default=None,
+                        help='Read the packets from a pcap file.')
+
+    parser.add_argument('--flow-timeout', type=float,
+                        required=False, default=FLOW_TIMEOUT,
+                        help='Forget connections idle for this many seconds.')
+
+    parser.add_argument('-f', '--format', choices=['plain', 'json'],
+                        required=False, default='plain',
+                        help='Write the URLs (plain) or JSON lines.')
+
+    parser.add_argument('-o', '--output', action='store',
+                        required=False, default=None,
+                        help='Write to a log file (compressed if it ends with .gz) instead of stdout.')
 
-    parser.add_argument('-i', '--interface', action='store',
-                        required=False, default="eth0",
-                        help='Interface to store variables')
+    parser.add_argument('--rotate-size', type=float,
+                        required=False, default=ROTATE_SIZE,
+                        help='Rotate the log file every ROTATE_SIZE megabytes (before compression).')
 
-    return parser.parse_args()
+    parser.add_argument('--rotate-count', type=int,
+                        required=False, default=ROTATE_COUNT,
+                        help='Keep ROTATE_COUNT rotated log files.')
+
+    parser.add_argument('--flush', type=float,
+                        required=False, default=0,
+                        help='Write the output every FLUSH seconds (default after every read).')
+
+    parser.add_argument('-a', '--aggregate', type=float,
+                        required=False, default=0,
+                        help='Write a summary of the requests every AGGREGATE seconds instead of each request.')
+
+    parser.add_argument('--window', type=float,
+                        required=False, default=0,
+                        help='Summarize the requests of the last WINDOW seconds (default AGGREGATE).')
+
+    parser.add_argument('--top', type=int,
+                        required=False, default=TOP,
+                        help='Summarize the TOP most requested hosts and URLs.')
+
+    parser.add_argument('--max-urls', type=int,
+                        required=False, default=MAX_URLS,
+                        help='Count (or remember) at most MAX_URLS hosts and URLs.')
+
+    parser.add_argument('--first', action='store_true',
+                        required=False, default=False,
+                        help='Only write the first request of each URL.')
+
+    parser.add_argument('-s', '--stats', type=float,
+                        required=False, default=0,
+                        help='Print the packet counters to stderr every STATS seconds.')
+
+    options = parser.parse_args()
+    if options.rotate_size <= 0:
+        parser.error("--rotate-size must be greater than 0")
+    if options.port is None:
+        options.port = [80]
+    if options.interface is None:
+        options.interface = ["eth0"]
+    return options
 
 def regexmatchgroup(regex, s):
     """
@@ -47,43 +206,1033 @@ def regexmatchgroup(regex, s):
     else:
         return None
 
-def parse_line(line):
+Request = collections.namedtuple('Request',
+        'time interface src sport dst dport method host target')
+
+
+def parse_line(line, interface=None):
     """
-    Parses the line, turning the line read from ngrep into something readable.
+    Parses the line, turning the line read from ngrep into a Request.
+    Returns None if there is no request in the line.
     """
-    path = regexmatchgroup(parse_line.path_regex, line)
+    m = parse_line.path_regex.search(line)
     host = regexmatchgroup(parse_line.host_regex, line)
 
-    if path:
+    if m:
         if host is None:
             host = regexmatchgroup(parse_line.ip_regex, line)
-        print("http://{0}/{1}".format(host, path))
-parse_line.path_regex = re.compile(r"(?:GET|HEAD)\s+/?(.+?)\s")
+        a = parse_line.address_regex.search(line)
+        if a is None:
+            return None
+        return Request(time.time(), interface, a.group(1), int(a.group(2)),
+                       a.group(3), int(a.group(4)), m.group(1), host, "/" + m.group(2))
+    return None
+parse_line.path_regex = re.compile(r"(GET|HEAD|POST)\s+/?(.+?)\s")
 parse_line.host_regex = re.compile(r"H[Oo][Ss][Tt]: (.+?)\|")
 parse_line.ip_regex = re.compile(r"-> (\d+\.\d+\.\d+\.\d+):\d+ [AP]")
+parse_line.address_regex = re.compile(r"T (\S+):(\d+) -> (\S+):(\d+) ")
 
 
-def main():
-    call = ['sudo', 'ngrep',
-            '-W', 'single',
-            '-d', options.interface,
-            '-P', '|',
-            '-l',
-            '-q',
-            '^GET |^POST ',
-            'tcp', 'and', 'port', str(options.port)
-    ]
-
-    p = subprocess.Popen(call,
-            stdout=subprocess.PIPE,
-            shell=False
-    )
+def request_url(target, host):
+    """
+    Returns the URL of the request target sent to host.
+    """
+    if target.startswith('http://') or target.startswith('https://'):
+        # the absolute form sent to proxies
+        return target
+    return "http://{0}/{1}".format(host, target.lstrip('/'))
+
+
+def text(s):
+    """
+    Returns the bytes s decoded for JSON, replacing what is not UTF-8.
+    """
+    if isinstance(s, bytes):
+        return s.decode('utf-8', 'replace')
+    return s
+
+
+def ip_host(ip):
+    """
+    Returns the ip as the host of a URL ([ip] for IPv6).
+    """
+    if ':' in ip:
+        return "[{0}]".format(ip)
+    return ip
+
+
+def request_host(request):
+    """
+    Returns the host the Request was sent to, its destination ip if it has no
+    Host header.
+    """
+    return request.host or ip_host(request.dst)
+
+
+def address(ip, port):
+    """
+    Returns the ip:port string of the address ([ip]:port for IPv6).
+    """
+    return "{0}:{1}".format(ip_host(ip), port)
+
+
+class RotatingFile(object):
+    """
+    A log file that is renamed to <name>.1 (or <name without .gz>.1.gz)
+    once size bytes have been written to it, keeping count rotated files.
+    The file is compressed if its name ends with .gz, the size being that of
+    the uncompressed data.
+    """
+    def __init__(self, filename, size, count):
+        self.filename = filename
+        self.size = size
+        self.count = count
+        self.rotations = 0
+        self._open()
+
+    def _open(self):
+        # a log file left by an earlier run is rotated with what is written
+        self.written = self._size()
+        if self.filename.endswith('.gz'):
+            # a new gzip member is appended to an existing file
+            self.fp = gzip.open(self.filename, 'ab')
+        else:
+            self.fp = open(self.filename, 'ab')
+
+    def _size(self):
+        # Returns the number of (uncompressed) bytes in the log file.
+        if not os.path.exists(self.filename):
+            return 0
+        if not self.filename.endswith('.gz'):
+            return os.path.getsize(self.filename)
+        size = 0
+        fp = gzip.open(self.filename, 'rb')
+        try:
+            while True:
+                data = fp.read(1 << 16)
+                if not data:
+                    break
+                size += len(data)
+        except (IOError, EOFError, struct.error, zlib.error):
+            # the last member was not finished, ie the run was killed
+            pass
+        finally:
+            fp.close()
+        return size
+
+    def _rotated(self, i):
+        if self.filename.endswith('.gz'):
+            return "{0}.{1}.gz".format(self.filename[:-3], i)
+        return "{0}.{1}".format(self.filename, i)
+
+    def rotate(self):
+        self.fp.close()
+        for i in range(self.count, 0, -1):
+            name = self.filename if i == 1 else self._rotated(i - 1)
+            if os.path.exists(name):
+                os.rename(name, self._rotated(i))
+        if self.count < 1:
+            os.remove(self.filename)
+        self.rotations += 1
+        self._open()
+
+    def write(self, data):
+        self.fp.write(data)
+        self.written += len(data)
+        if self.written >= self.size:
+            self.rotate()
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+class Output(object):
+    """
+    Writes the requests to fp in the format ('plain' or 'json'), buffering
+    them for up to interval seconds.
+    """
+    def __init__(self, fp, format='plain', interval=0, tagged=False):
+        self.fp = fp
+        self.format = format
+        self.interval = interval
+        self.tagged = tagged
+        self.buffer = []
+        self.flushed = time.time()
+        self.written = 0
+        self.flushes = 0
+        self.bytes = 0
+
+    def write(self, request):
+        """
+        Writes the Request.
+        """
+        url = request_url(request.target, request_host(request))
+        if self.format == 'json':
+            line = json.dumps({
+                'time': round(request.time, 6),
+                'date': datetime.datetime.fromtimestamp(request.time).isoformat(),
+                'interface': request.interface,
+                'src': address(request.src, request.sport),
+                'dst': address(request.dst, request.dport),
+                'method': text(request.method),
+                'host': text(request.host),
+                'path': text(request.target),
+                'url': text(url),
+            }, sort_keys=True)
+        elif self.tagged:
+            line = "{0}:{1} {2}".format(request.interface, request.dport, url)
+        else:
+            line = url
+        self.buffer.append(line)
+        self.written += 1
+
+    def write_summary(self, summary):
+        """
+        Writes the summary of an Aggregator.
+        """
+        if self.format == 'json':
+            self.buffer.append(json.dumps(dict(summary,
+                date=datetime.datetime.fromtimestamp(summary['time']).isoformat(),
+                hosts=[[text(h), n] for h, n in summary['hosts']],
+                urls=[[text(u), n] for u, n in summary['urls']]), sort_keys=True))
+            return
+        self.buffer.append("# {0} {1:g}s: {2} requests, {3} hosts, {4} urls".format(
+                datetime.datetime.fromtimestamp(summary['time']).strftime('%Y-%m-%d %H:%M:%S'),
+                summary['window'], summary['requests'], summary['host_count'],
+                summary['url_count']))
+        for h, n in summary['hosts']:
+            self.buffer.append("{0:8d} {1}".format(n, h))
+        for u, n in summary['urls']:
+            self.buffer.append("{0:8d} {1}".format(n, u))
+
+    def tick(self):
+        """
+        Flushes the buffered requests if they are due to be written.
+        """
+        if self.buffer and time.time() - self.flushed >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            data = "\n".join(self.buffer) + "\n"
+            self.buffer = []
+            self.fp.write(data)
+            self.bytes += len(data)
+        self.fp.flush()
+        self.flushes += 1
+        self.flushed = time.time()
+
+    def timeout(self):
+        """
+        Returns the number of seconds until the buffer is due to be written,
+        or None if it is empty.
+        """
+        if not self.buffer:
+            return None
+        return max(self.interval - (time.time() - self.flushed), 0)
+
+
+class LRUCounter(object):
+    """
+    Counts the requests of at most size keys, forgetting the least recently
+    counted key when another one is added.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.counts = collections.OrderedDict()
+        self.evicted = 0
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, n=1):
+        """
+        Counts n requests of key. Returns True if the key is new.
+        """
+        new = key not in self.counts
+        n += self.counts.pop(key, 0)
+        if new and len(self.counts) >= self.size:
+            self.counts.popitem(last=False)
+            self.evicted += 1
+        self.counts[key] = n
+        return new
+
+    def items(self):
+        return self.counts.items()
+
+
+class Aggregator(object):
+    """
+    Counts the requests per host and URL, and writes a summary of the top
+    most requested ones of the last window seconds to the Output every
+    interval seconds. The window is split into slots of interval seconds,
+    each counting at most size hosts and URLs.
+
+    With first, the first request of each URL is also written to the Output
+    (or each request, without an interval).
+
+    The time is the time of the requests, so a pcap file is summarized as it
+    was captured, unless live is true.
+    """
+    def __init__(self, output, interval=0, window=0, top=TOP, size=MAX_URLS,
+                 first=False, live=True):
+        self.output = output
+        self.interval = interval
+        self.top = top
+        self.size = size
+        self.live = live
+        self.seen = LRUCounter(size) if first else None
+        self.slots = collections.deque(maxlen=max(int(math.ceil(window / interval)), 1)
+                                       if interval > 0 and window > 0 else 1)
+        self.now = time.time() if live else None
+        self.next = None
+        self.requests = 0
+        self.summaries = 0
+        self.repeated = 0
+        self.evicted = 0
+
+    def _slot(self):
+        # the [requests, hosts, urls] counted in an interval.
+        return [0, LRUCounter(self.size), LRUCounter(self.size)]
+
+    def _clock(self, now=None):
+        # Advances the time, writing the summaries that are due.
+        if self.live or now is not None:
+            self.now = time.time() if self.live else max(now, self.now or now)
+        if self.interval <= 0 or self.now is None:
+            return
+        if self.next is None:
+            self.next = self.now + self.interval
+            self.slots.append(self._slot())
+        while self.now >= self.next:
+            self.summarize(self.next)
+            self.next += self.interval
+            if self.next < self.now - self.interval * self.slots.maxlen:
+                # nothing has been counted in the slots skipped.
+                self.next += (self.now - self.next) // self.interval * self.interval
+                self.slots.clear()
+            self.slots.append(self._slot())
+
+    def write(self, request):
+        """
+        Counts the Request, writing it if it is the first request of its
+        URL (or if there is nothing to summarize).
+        """
+        self._clock(request.time)
+        url = request_url(request.target, request_host(request))
+        if self.seen is not None:
+            if self.seen.add(url):
+                self.output.write(request)
+            else:
+                self.repeated += 1
+        elif self.interval <= 0:
+            self.output.write(request)
+        if self.interval > 0:
+            slot = self.slots[-1]
+            slot[0] += 1
+            slot[1].add(request_host(request))
+            slot[2].add(url)
+            self.requests += 1
+
+    def summary(self, now):
+        """
+        Returns the summary of the requests counted in the window, as a
+        dictionary.
+        """
+        hosts = collections.defaultdict(int)
+        urls = collections.defaultdict(int)
+        for requests, slot_hosts, slot_urls in self.slots:
+            for h, n in slot_hosts.items():
+                hosts[h] += n
+            for u, n in slot_urls.items():
+                urls[u] += n
+        get = lambda item: item[1]
+        return dict(time=now, window=self.interval * len(self.slots),
+                    requests=sum(slot[0] for slot in self.slots),
+                    host_count=len(hosts), url_count=len(urls),
+                    hosts=heapq.nlargest(self.top, hosts.items(), key=get),
+                    urls=heapq.nlargest(self.top, urls.items(), key=get))
+
+    def summarize(self, now):
+        """
+        Writes the summary of the window to the Output.
+        """
+        self.output.write_summary(self.summary(now))
+        self.summaries += 1
+        self.evicted = sum(h.evicted + u.evicted for n, h, u in self.slots)
+
+    def tick(self):
+        """
+        Writes the summaries that are due, and flushes the Output.
+        """
+        self._clock()
+        self.output.tick()
+
+    def timeout(self):
+        """
+        Returns the number of seconds until the next summary or until the
+        Output is due to be written, or None.
+        """
+        timeouts = [self.output.timeout()]
+        if self.live and self.next is not None:
+            timeouts.append(max(self.next - time.time(), 0))
+        timeouts = [t for t in timeouts if t is not None]
+        return min(timeouts) if timeouts else None
 
+    def flush(self):
+        """
+        Writes the summary of the requests counted since the last summary,
+        and flushes the Output.
+        """
+        if self.next is not None and self.requests and (
+                self.summaries == 0 or self.slots[-1][0]):
+            self.summarize(self.now)
+        self.output.flush()
+
+
+class RequestParser(object):
+    """
+    An incremental parser of the HTTP/1.x requests sent on a connection.
+
+    The data of the connection is fed to it in order, and it returns the
+    (method, target, host) of each request once its headers have been
+    received. Request bodies with a Content-Length are skipped without being
+    buffered. After data is lost (or a chunked body), the data is skipped up
+    to the next line starting a request.
+    """
+    request_regex = re.compile(r"^([A-Z]+) +(\S+) +HTTP/1\.[0-9]\r?$")
+    start_regex = re.compile(r"(?:^|\n)(?:GET|HEAD|POST|PUT|DELETE|OPTIONS|PATCH|TRACE|CONNECT) ")
+
+    def __init__(self, max_size=MAX_REQUEST):
+        self.max_size = max_size
+        self.buffer = b''
+        self.skip = 0           # body bytes left to skip
+        self.synced = True      # whether the buffer starts with a request
+        self.overflows = 0
+
+    def lost(self):
+        """
+        Notes that data of the connection was lost.
+        """
+        self.buffer = b''
+        self.skip = 0
+        self.synced = False
+
+    def _resync(self):
+        m = self.start_regex.search(self.buffer)
+        if m is None:
+            # a method may be split over the next packet
+            self.buffer = self.buffer[-8:]
+            return False
+        self.buffer = self.buffer[m.start():].lstrip(b'\n')
+        self.synced = True
+        return True
+
+    def feed(self, data):
+        """
+        Parses the next data of the connection, returning the list of the
+        requests whose headers are complete.
+        """
+        if self.skip:
+            n = min(self.skip, len(data))
+            self.skip -= n
+            data = data[n:]
+        self.buffer += data
+        requests = []
+        while self.buffer:
+            if not self.synced and not self._resync():
+                break
+            end = self.buffer.find(b'\r\n\r\n')
+            if end < 0:
+                end = self.buffer.find(b'\n\n')
+                if end < 0:
+                    if len(self.buffer) > self.max_size:
+                        self.overflows += 1
+                        self.lost()
+                    break
+                size = end + 2
+            else:
+                size = end + 4
+            head = self.buffer[:end].split(b'\n')
+            self.buffer = self.buffer[size:]
+            m = self.request_regex.match(head[0])
+            if m is None:
+                self.synced = False
+                continue
+            host = None
+            length = 0
+            for line in head[1:]:
+                name, sep, value = line.partition(b':')
+                name = name.strip().lower()
+                if name == b'host':
+                    host = value.strip()
+                elif name == b'content-length':
+                    try:
+                        length = int(value.strip())
+                    except ValueError:
+                        pass
+                elif name == b'transfer-encoding' and value.strip().lower() != b'identity':
+                    # find the next request after the chunked body
+                    self.synced = False
+            requests.append((m.group(1), m.group(2), host))
+            if length:
+                n = min(length, len(self.buffer))
+                self.buffer = self.buffer[n:]
+                self.skip = length - n
+        return requests
+
+
+class Flow(object):
+    """
+    The client to server stream of a TCP connection, put back in order from
+    its packets.
+    """
+    __slots__ = ('next_seq', 'pending', 'pending_size', 'parser', 'last')
+
+    def __init__(self):
+        self.next_seq = None
+        self.pending = {}       # sequence number -> out of order data
+        self.pending_size = 0
+        self.parser = RequestParser()
+        self.last = 0
+
+    def segment(self, seq, flags, payload):
+        """
+        Adds the packet with sequence number seq to the stream, returning
+        the list of requests completed by it.
+        """
+        if flags & TCP_SYN:
+            self.next_seq = (seq + 1) & 0xffffffff
+            self.pending.clear()
+            self.pending_size = 0
+            return []
+        if self.next_seq is None:
+            # the connection was already open
+            self.next_seq = seq
+            self.parser.synced = False
+        if not payload:
+            return []
+        requests = []
+        offset = (seq - self.next_seq) & 0xffffffff
+        if offset >= 0x80000000:
+            # a retransmission, keep the data that was not seen
+            offset = 0x100000000 - offset
+            if offset >= len(payload):
+                return []
+            payload = payload[offset:]
+        elif offset > 0:
+            # out of order
+            if seq not in self.pending:
+                self.pending[seq] = payload
+                self.pending_size += len(payload)
+            if self.pending_size <= MAX_PENDING:
+                return []
+            # give up on the missing data
+            self.parser.lost()
+            payload = b''
+            self.next_seq = min(self.pending, key=lambda s: (s - self.next_seq) & 0xffffffff)
+        while True:
+            if payload:
+                requests.extend(self.parser.feed(payload))
+                self.next_seq = (self.next_seq + len(payload)) & 0xffffffff
+            payload = None
+            # the data that is now in order, dropping what a retransmission
+            # has already covered.
+            for start in list(self.pending):
+                behind = (self.next_seq - start) & 0xffffffff
+                if behind >= 0x80000000:
+                    continue
+                data = self.pending.pop(start)
+                self.pending_size -= len(data)
+                if behind < len(data):
+                    payload = data[behind:]
+                    break
+            if payload is None:
+                break
+        return requests
+
+
+class FlowTable(object):
+    """
+    The flows of the connections being followed, keyed by their (source ip,
+    source port, destination ip, destination port).
+
+    The least recently used flow is forgotten when there are max_flows flows,
+    and flows are forgotten once they have been idle for timeout seconds.
+    """
+    def __init__(self, timeout=FLOW_TIMEOUT, max_flows=MAX_FLOWS):
+        self.timeout = timeout
+        self.max_flows = max_flows
+        self.flows = collections.OrderedDict()  # least recently used first
+        self.evicted = 0
+        self.overflows = 0
+
+    def packet(self, key, seq, flags, payload, now):
+        """
+        Adds the TCP packet of the connection key seen at time now, returning
+        the list of requests completed by it.
+        """
+        flow = self.flows.pop(key, None)
+        if flow is None:
+            if flags & TCP_RST or (flags & TCP_FIN and not payload):
+                return []
+            flow = Flow()
+            if len(self.flows) >= self.max_flows:
+                self._forget(self.flows.popitem(last=False)[1])
+                self.evicted += 1
+        flow.last = now
+        requests = flow.segment(seq, flags, payload)
+        if flags & (TCP_FIN | TCP_RST):
+            self._forget(flow)
+        else:
+            self.flows[key] = flow
+        return requests
+
+    def _forget(self, flow):
+        self.overflows += flow.parser.overflows
+
+    def expire(self, now):
+        """
+        Forgets the flows that have been idle for timeout seconds.
+        """
+        while self.flows:
+            key = next(iter(self.flows))
+            flow = self.flows[key]
+            if now - flow.last < self.timeout:
+                break
+            del self.flows[key]
+            self._forget(flow)
+            self.evicted += 1
+
+
+class Counters(object):
+    """
+    The packet counters of a capture, printed to stderr every interval
+    seconds.
+    """
+    def __init__(self, interval=0):
+        self.interval = interval
+        self.start = self.last = time.time()
+        self.packets = 0
+        self.requests = 0
+        self.drops = 0
+        self.flows = None
+        self.output = None
+        self.aggregator = None
+
+    def due(self):
+        """
+        Returns true if the counters are due to be printed.
+        """
+        return self.interval > 0 and time.time() - self.last >= self.interval
+
+    def report(self):
+        seconds = max(time.time() - self.start, 0.001)
+        sys.stderr.write("{0} packets ({1:.0f}/sec), {2} requests, {3} dropped".format(
+                self.packets, self.packets / seconds, self.requests, self.drops))
+        if self.flows is not None:
+            sys.stderr.write(", {0} connections, {1} evicted, {2} oversized requests".format(
+                    len(self.flows.flows), self.flows.evicted, self.flows.overflows))
+        if self.output is not None:
+            sys.stderr.write(", {0} written ({1} bytes in {2} flushes)".format(
+                    self.output.written, self.output.bytes, self.output.flushes))
+            if isinstance(self.output.fp, RotatingFile):
+                sys.stderr.write(", {0} rotations".format(self.output.fp.rotations))
+        if self.aggregator is not None:
+            sys.stderr.write(", {0} summaries, {1} repeated, {2} forgotten".format(
+                    self.aggregator.summaries, self.aggregator.repeated,
+                    self.aggregator.evicted + (self.aggregator.seen.evicted
+                                               if self.aggregator.seen is not None else 0)))
+        sys.stderr.write("\n")
+        self.last = time.time()
+
+
+def tcp_port_filter(ports, snaplen=SNAPLEN):
+    """
+    Returns the classic BPF program (as a list of (code, jt, jf, k)) that
+    accepts the IPv4 and IPv6 TCP packets sent to any of the ports, like the
+    filter 'tcp and (dst port <port> or ...)'. The responses are not needed
+    to find the requests.
+    """
+    def match_ports():
+        # jumps to accept if the loaded port is one of the ports.
+        return [[0x15, 'accept', 0 if i < len(ports) - 1 else 'reject', port]
+                for i, port in enumerate(ports)]
+
+    program = (
+        [[0x28, 0, 0, 12],          # ldh [12]                  ethertype
+         [0x15, 0, 'ipv4', 0x86dd], # jeq #ipv6, next, ipv4
+         [0x30, 0, 0, 20],          # ldb [20]                  next header
+         [0x15, 0, 'reject', 6],    # jeq #tcp, next, reject
+         [0x28, 0, 0, 56]] +        # ldh [56]                  destination port
+        match_ports() +
+        [['ipv4', 0x15, 0, 'reject', 0x0800],
+                                    # jeq #ipv4, next, reject
+         [0x30, 0, 0, 23],          # ldb [23]                  protocol
+         [0x15, 0, 'reject', 6],    # jeq #tcp, next, reject
+         [0x28, 0, 0, 20],          # ldh [20]                  fragment offset
+         [0x45, 'reject', 0, 0x1fff],
+                                    # jset #0x1fff, reject, next
+         [0xb1, 0, 0, 14],          # ldxb 4*([14]&0xf)         header length
+         [0x48, 0, 0, 16]] +        # ldh [x + 16]              destination port
+        match_ports() +
+        [['accept', 0x06, 0, 0, snaplen],
+         ['reject', 0x06, 0, 0, 0]])
+
+    # resolve the labels to relative jumps
+    labels = {}
+    for i, instruction in enumerate(program):
+        if isinstance(instruction[0], str):
+            labels[instruction.pop(0)] = i
+    for i, instruction in enumerate(program):
+        for j in (1, 2):
+            if isinstance(instruction[j], str):
+                instruction[j] = labels[instruction[j]] - i - 1
+                if instruction[j] > 255:
+                    raise ValueError("Too many ports to filter")
+    return [tuple(i) for i in program]
+
+
+def attach_filter(sock, program):
+    """
+    Attaches the classic BPF program to the socket, so the kernel drops the
+    packets it does not accept.
+    """
+    code = ctypes.create_string_buffer(
+            b"".join(struct.pack("HBBI", *i) for i in program))
+    fprog = struct.pack("HL", len(program), ctypes.addressof(code))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def open_socket(interface, ports):
+    """
+    Opens an AF_PACKET socket capturing the TCP packets sent to the ports on
+    the interface.
+    """
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+    attach_filter(sock, tcp_port_filter(ports))
+    sock.bind((interface, ETH_P_ALL))
+    # packets that arrived before the filter was attached
+    sock.setblocking(False)
+    try:
+        while True:
+            sock.recv(SNAPLEN)
+    except socket.error:
+        pass
+    return sock
+
+
+def socket_drops(sock):
+    """
+    Returns the number of packets the kernel dropped since the last call.
+    """
+    packets, drops = struct.unpack("II", sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, 8))
+    return drops
+
+
+def read_batch(sock, batch=BATCH):
+    """
+    Returns the list of up to batch packets that can be read from the non
+    blocking socket without waiting.
+    """
+    packets = []
+    try:
+        while len(packets) < batch:
+            packet, address = sock.recvfrom(SNAPLEN)
+            if address[2] == PACKET_OUTGOING and address[3] == ARPHRD_LOOPBACK:
+                # the loopback interface receives the packets it sends
+                continue
+            packets.append(packet)
+    except socket.error as e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+    return packets
+
+
+def read_pcap(fp):
+    """
+    Generator that reads a pcap file, yielding its link type and then the
+    (time, data) of each packet.
+    """
+    header = fp.read(24)
+    if len(header) < 24:
+        raise ValueError("Not a pcap file")
+    for endian in "<>":
+        magic, = struct.unpack(endian + "I", header[:4])
+        if magic in (0xa1b2c3d4, 0xa1b23c4d):
+            # microsecond or nanosecond timestamps
+            scale = 1e6 if magic == 0xa1b2c3d4 else 1e9
+            break
+    else:
+        raise ValueError("Not a pcap file (pcapng is not supported)")
+    linktype, = struct.unpack(endian + "I", header[20:24])
+    yield linktype
+    record = struct.Struct(endian + "IIII")
     while True:
-        line = p.stdout.readline()
-        if len(line) > 0 and line[0] == 'T':
-            parse_line(line)
-            sys.stdout.flush()
+        header = fp.read(16)
+        if len(header) < 16:
+            return
+        sec, usec, caplen, length = record.unpack(header)
+        data = fp.read(caplen)
+        if len(data) < caplen:
+            return
+        yield sec + usec / scale, data
+
+
+def tcp_payload(packet, linktype=LINKTYPE_ETHERNET):
+    """
+    Parses the IPv4 or IPv6 TCP packet, returning the tuple (source ip,
+    source port, destination ip, destination port, sequence number, flags,
+    payload).
+    Returns None if the packet is not a TCP packet.
+    """
+    if linktype == LINKTYPE_ETHERNET:
+        offset = 14
+        ethertype, = struct.unpack_from("!H", packet, 12)
+        while ethertype in (0x8100, 0x88a8) and len(packet) >= offset + 4:
+            # VLAN tags
+            ethertype, = struct.unpack_from("!H", packet, offset + 2)
+            offset += 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        offset = 16
+        ethertype, = struct.unpack_from("!H", packet, 14)
+    elif linktype == LINKTYPE_RAW:
+        offset = 0
+        ethertype = 0x86dd if ord(packet[0:1]) >> 4 == 6 else 0x0800
+    else:
+        raise ValueError("Unsupported link type {0}".format(linktype))
+
+    if ethertype == 0x0800:
+        if len(packet) < offset + 20:
+            return None
+        ihl = (ord(packet[offset:offset + 1]) & 0xf) * 4
+        length, fragment, protocol = struct.unpack_from("!2xH2xHxB", packet, offset)
+        if protocol != 6 or fragment & 0x1fff:
+            return None
+        src = socket.inet_ntop(socket.AF_INET, packet[offset + 12:offset + 16])
+        dst = socket.inet_ntop(socket.AF_INET, packet[offset + 16:offset + 20])
+        end = offset + length
+        if length == 0:
+            # ie, a segmentation offloaded packet
+            end = len(packet)
+        offset += ihl
+    elif ethertype == 0x86dd:
+        if len(packet) < offset + 40:
+            return None
+        length, protocol = struct.unpack_from("!4xHB", packet, offset)
+        if protocol != 6:
+            return None
+        src = socket.inet_ntop(socket.AF_INET6, packet[offset + 8:offset + 24])
+        dst = socket.inet_ntop(socket.AF_INET6, packet[offset + 24:offset + 40])
+        offset += 40
+        end = offset + length
+    else:
+        return None
+
+    if len(packet) < offset + 20:
+        return None
+    sport, dport, seq, length, flags = struct.unpack_from("!HHI4xBB", packet, offset)
+    offset += (length >> 4) * 4
+    # ethernet frames may be padded.
+    return src, sport, dst, dport, seq, flags, packet[offset:end]
+
+
+def process_packets(packets, linktype, flows, counters, ports, interface, output):
+    """
+    Parses the (time, packet) tuples captured on the interface, and writes
+    the requests sent to the ports in them to the Output.
+    """
+    for now, packet in packets:
+        counters.packets += 1
+        try:
+            tcp = tcp_payload(packet, linktype)
+        except struct.error:
+            # a truncated packet
+            continue
+        if tcp is None:
+            continue
+        src, sport, dst, dport, seq, flags, payload = tcp
+        if dport not in ports:
+            continue
+        key = (interface, src, sport, dst, dport)
+        for method, target, host in flows.packet(key, seq, flags, payload, now):
+            if method in METHODS:
+                output.write(Request(now, interface, src, sport, dst, dport, method, host, target))
+                counters.requests += 1
+
+
+def capture_pcap(filename, counters, output):
+    """
+    Writes the requests in the pcap file.
+    """
+    flows = FlowTable(options.flow_timeout)
+    counters.flows = flows
+    interface = os.path.basename(filename)
+    fp = open(filename, 'rb')
+    packets = read_pcap(fp)
+    linktype = next(packets)
+    batch = []
+    for packet in packets:
+        batch.append(packet)
+        if len(batch) >= BATCH:
+            process_packets(batch, linktype, flows, counters, options.port, interface, output)
+            output.tick()
+            flows.expire(batch[-1][0])
+            batch = []
+    process_packets(batch, linktype, flows, counters, options.port, interface, output)
+    fp.close()
+
+
+class PacketCapture(object):
+    """
+    The capture of the requests sent to the ports on an interface, from an
+    AF_PACKET socket.
+    """
+    def __init__(self, interface, ports, flows):
+        self.interface = interface
+        self.ports = ports
+        self.flows = flows
+        self.sock = open_socket(interface, ports)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read(self, counters, output):
+        """
+        Reads and parses the packets waiting on the socket. Returns False
+        once the capture has ended.
+        """
+        packets = read_batch(self.sock)
+        now = time.time()
+        process_packets([(now, p) for p in packets], LINKTYPE_ETHERNET,
+                        self.flows, counters, self.ports, self.interface, output)
+        return True
+
+    def drops(self):
+        return socket_drops(self.sock)
+
+
+class NgrepCapture(object):
+    """
+    The capture of the requests sent to the ports on an interface, read from
+    the output of ngrep.
+    """
+    def __init__(self, interface, ports):
+        self.interface = interface
+        expression = " or ".join("port {0}".format(port) for port in ports)
+        call = ['sudo', 'ngrep',
+                '-W', 'single',
+                '-d', interface,
+                '-P', '|',
+                '-l',
+                '-q',
+                '^GET |^POST ',
+                'tcp and ({0})'.format(expression)
+        ]
+
+        self.p = subprocess.Popen(call,
+                stdout=subprocess.PIPE,
+                shell=False
+        )
+        self.buffer = b''
+
+    def fileno(self):
+        return self.p.stdout.fileno()
+
+    def read(self, counters, output):
+        """
+        Reads and parses the lines ngrep has written. Returns False once
+        ngrep has exited.
+        """
+        data = os.read(self.fileno(), 65536)
+        if not data:
+            return False
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            if len(line) > 0 and line[0:1] == b'T':
+                counters.packets += 1
+                request = parse_line(line, self.interface)
+                if request is not None:
+                    output.write(request)
+                    counters.requests += 1
+        return True
+
+    def drops(self):
+        return 0
+
+
+def capture(captures, flows, counters, output):
+    """
+    Reads the captures as their data arrives, until all of them have ended.
+    """
+    expired = time.time()
+    while captures:
+        timeouts = [t for t in (options.stats or None, output.timeout()) if t is not None]
+        try:
+            readable, writable, errors = select.select(captures, [], [],
+                                                       min(timeouts) if timeouts else None)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            continue
+        for c in readable:
+            if not c.read(counters, output):
+                captures.remove(c)
+        output.tick()
+        now = time.time()
+        if flows is not None and now - expired >= 1:
+            flows.expire(now)
+            expired = now
+        if counters.due():
+            counters.drops += sum(c.drops() for c in captures)
+            counters.report()
+
+
+def main():
+    counters = Counters(options.stats)
+    if options.output:
+        fp = RotatingFile(options.output, int(options.rotate_size * 1024 * 1024),
+                          options.rotate_count)
+    else:
+        fp = sys.stdout
+    tagged = len(options.interface) > 1 or len(options.port) > 1
+    output = Output(fp, options.format, options.flush, tagged)
+    counters.output = output
+    if options.aggregate > 0 or options.first:
+        # the requests are written through the Aggregator
+        output = Aggregator(output, options.aggregate, options.window or options.aggregate,
+                            options.top, options.max_urls, options.first,
+                            live=not options.read)
+        counters.aggregator = output
+    # print the counters when killed, or asked to.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    signal.signal(signal.SIGUSR1, lambda signum, frame: counters.report())
+    try:
+        if options.read:
+            capture_pcap(options.read, counters, output)
+        elif options.backend == 'packet':
+            flows = FlowTable(options.flow_timeout)
+            counters.flows = flows
+            capture([PacketCapture(i, options.port, flows) for i in options.interface],
+                    flows, counters, output)
+        else:
+            capture([NgrepCapture(i, options.port) for i in options.interface],
+                    None, counters, output)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        output.flush()
+        if fp is not sys.stdout:
+            fp.close()
+        if options.stats or options.verbose:
+            counters.report()
 
 
 if __name__ == '__main__':